@@ -0,0 +1,350 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Headless benchmarks for the tessellation, mapping and drawing
+stages.
+
+Run it as
+
+  ./benchmark.py --output results.json
+
+and later compare a new run against the saved results with
+
+  ./benchmark.py --compare results.json
+
+which exits with status 1 if any stage got slower than the
+threshold. Besides times, the memory taken by each vertex of the
+tessellation and the number of geometry objects created by the object
+based stages are tracked too (and compared in the same way)."""
+
+import sys
+import math
+import json
+import time
+import argparse
+import platform
+import timeit
+
+import cairo as cairolib
+import Image
+import ImageDraw
+
+import euclidean
+import hyperbolic
+import polygons
+import raster
+import instances
+import panning
+import draw
+
+DEFAULT_TILINGS = [(5, 5), (4, 5), (7, 3)]
+DEFAULT_CUTOFFS = [2, 3, 4]
+DEFAULT_SIZE = (1920, 1080)
+DEFAULT_FRAMES = 30
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.1
+
+# Coxeter tessellations are cut by word length rather than by ring
+# depth; each ring takes roughly this many letters
+COXETER_LENGTH_PER_RING = 4
+
+# Instances of these classes count as allocations of the geometry
+# core
+GEOMETRY_CLASSES = [euclidean.EuPoint, euclidean.EuLine, euclidean.EuCircle,
+                    hyperbolic.Point, hyperbolic.InfPoint, hyperbolic.Segment,
+                    hyperbolic.Line, hyperbolic.Isometry, hyperbolic.PointedVector]
+
+# Quantities, other than time, that are compared with the baseline
+TRACKED_COUNTS = ['bytes_per_vertex', 'allocations']
+
+# Whole frames are timed with each of these (stage name, backend)
+BACKENDS = [('frame', hyperbolic.PilBackend()),
+            ('frame_cairo', hyperbolic.CairoBackend()),
+            ('frame_numpy', raster.NumpyBackend()),
+            ('frame_numpy_aliased', raster.NumpyBackend(antialias=False)),
+            ('frame_banded', raster.BandedBackend())]
+
+def init_headless_context(size, poincare=True, backend=None):
+    """A context drawing on an offscreen image, with the same
+    coordinate system as the viewer."""
+    frame_data = bytearray(4 * size[0] * size[1])
+    cairo_surf = cairolib.ImageSurface.create_for_data(frame_data, cairolib.FORMAT_ARGB32, size[0], size[1])
+    cairo = cairolib.Context(cairo_surf)
+    versor_len = 0.45 * min(size)
+    reflect = cairolib.Matrix(1.0, 0.0, 0.0, -1.0, 0.0, 0.0)
+    cairo.transform(reflect)
+    cairo.translate(size[0]/2, -size[1]/2)
+    cairo.scale(versor_len, versor_len)
+
+    ctx = hyperbolic.HyperbolicContext(cairo, hyperbolic.Isometry(), poincare=poincare, size=size,
+                                       backend=backend)
+    ctx.image = Image.frombuffer("RGBA", size, frame_data, 'raw', 'RGBA', 0, 1)
+    ctx.image.readonly = 0
+    ctx.image_draw = ImageDraw.Draw(ctx.image)
+    ctx.pixels = raster.get_pixels(frame_data, size)
+    return ctx
+
+def get_scripted_isometries(frames):
+    """A deterministic sequence of view isometries: a slow drift
+    along a circle, combined with a rotation."""
+    isoms = []
+    isom = hyperbolic.Isometry()
+    for frame in xrange(frames):
+        alpha = 2.0 * math.pi * frame / frames
+        trans = hyperbolic.Isometry.translation(0.0, 0.0, 0.02 * math.cos(alpha), 0.02 * math.sin(alpha))
+        rot = hyperbolic.Isometry.rotation(0.1, 0.0, 0.05)
+        isom = rot.compose(trans).compose(isom)
+        isoms.append(isom)
+    return isoms
+
+def time_it(func, repeat):
+    """Best wall clock time out of repeat runs, and the result of the
+    last run."""
+    best = None
+    for i in xrange(repeat):
+        start = timeit.default_timer()
+        result = func()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def get_attribute_values(obj):
+    """The values of the attributes of obj, both the ones in its
+    __dict__ and the ones in the __slots__ of its class and of the
+    classes it derives from."""
+    values = []
+    if hasattr(obj, '__dict__'):
+        values.extend(obj.__dict__.values())
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+def get_object_size(obj):
+    """Bytes taken by obj, by its __dict__, if it has one, and by the
+    values of its attributes (but not by what they refer to in turn).
+    Values shared between attributes, and None, are only counted
+    once."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    seen = set([id(obj), id(None)])
+    for value in get_attribute_values(obj):
+        if id(value) not in seen:
+            seen.add(id(value))
+            size += sys.getsizeof(value)
+    return size
+
+def count_allocations(func, classes=GEOMETRY_CLASSES):
+    """Call func and return the number of instances of classes that it
+    created (i.e. of calls to their __init__) and its result."""
+    codes = set(cls.__init__.im_func.func_code for cls in classes)
+    count = [0]
+    def profile(frame, event, arg):
+        if event == 'call' and frame.f_code in codes:
+            count[0] += 1
+    sys.setprofile(profile)
+    try:
+        result = func()
+    finally:
+        sys.setprofile(None)
+    return count[0], result
+
+def time_frames(ctx, isoms, draw):
+    """Call draw() once for each view isometry, and return the stage
+    with the statistics of the frame times."""
+    frame_times = []
+    for isom in isoms:
+        ctx.isom = isom
+        start = timeit.default_timer()
+        draw()
+        frame_times.append(timeit.default_timer() - start)
+    frame_times.sort()
+    return {'seconds': sum(frame_times) / len(frame_times),
+            'median': frame_times[len(frame_times) // 2],
+            'max': frame_times[-1],
+            'frames': len(isoms)}
+
+def draw_instances_frame(ctx, tile_instances):
+    ctx.cull_stats.reset()
+    ctx.backend.clear(ctx, (255, 255, 255))
+    instances.draw_instances(ctx, tile_instances)
+    ctx.backend.finish(ctx)
+    ctx.backend.draw_circle(ctx, 0.0, 0.0, 1.0, (255, 0, 0))
+
+def run_case(side_num, valence_num, cutoff, size, frames, repeat):
+    stages = {}
+    pv = hyperbolic.PointedVector(0.0, 0.0, 0.0)
+
+    elapsed, tessellation = time_it(lambda: polygons.build_regular_tessellation(
+        side_num, valence_num, pv, max_depth=cutoff), repeat)
+    vertices = dict((id(p), p) for points in tessellation for p in points).values()
+    stages['build_regular_tessellation'] = {'seconds': elapsed, 'tiles': len(tessellation),
+                                            'vertices': len(vertices),
+                                            'bytes_per_vertex': float(sum(map(get_object_size, vertices))) / len(vertices)}
+
+    # The tessellation as the viewer draws it
+    elapsed, rooted = time_it(lambda: panning.RootedTessellation(
+        side_num, valence_num, max_length=COXETER_LENGTH_PER_RING * cutoff), repeat)
+    stages['build_rooted_tessellation'] = {'seconds': elapsed, 'tiles': rooted.get_tile_num()}
+
+    elapsed, segments = time_it(lambda: polygons.build_segment_list(tessellation), repeat)
+    stages['build_segment_list'] = {'seconds': elapsed, 'segments': len(segments)}
+
+    isom = hyperbolic.Isometry.translation(0.1, 0.0, 0.4, 0.2)
+    points = [p for segment in segments for p in segment]
+    elapsed, mapped = time_it(lambda: [isom.map(p) for p in points], repeat)
+    allocations, mapped = count_allocations(lambda: [isom.map(p) for p in points])
+    stages['isometry_map'] = {'seconds': elapsed, 'points': len(points),
+                              'points_per_second': len(points) / elapsed,
+                              'allocations': allocations}
+
+    array = polygons.build_segment_array(segments)
+    elapsed, mapped_array = time_it(lambda: isom.map_array(array), repeat)
+    stages['isometry_map_array'] = {'seconds': elapsed, 'points': len(points),
+                                    'points_per_second': len(points) / elapsed}
+
+    mapped_segments = [hyperbolic.Segment(mapped[2*i], mapped[2*i+1]) for i in xrange(len(segments))]
+    for poincare in [False, True]:
+        ctx = init_headless_context(size, poincare=poincare)
+        if poincare:
+            draw_segments = lambda: [s.draw_poincare(ctx, dont_map=True) for s in mapped_segments]
+            name = 'segment_draw_poincare'
+        else:
+            draw_segments = lambda: [s.draw_klein(ctx, dont_map=True) for s in mapped_segments]
+            name = 'segment_draw_klein'
+        elapsed, result = time_it(draw_segments, repeat)
+        stages[name] = {'seconds': elapsed, 'segments': len(segments),
+                        'segments_per_second': len(segments) / elapsed}
+
+    # A whole frame drawn one geometry object at a time: each segment
+    # is mapped by the view isometry and then drawn
+    segment_objects = [hyperbolic.Segment(p1, p2) for p1, p2 in segments]
+    ctx = init_headless_context(size)
+    ctx.isom = isom
+    draw_segments = lambda: [s.draw(ctx) for s in segment_objects]
+    elapsed, result = time_it(draw_segments, repeat)
+    allocations, result = count_allocations(draw_segments)
+    stages['frame_objects'] = {'seconds': elapsed, 'segments': len(segments),
+                               'allocations': allocations}
+
+    isoms = get_scripted_isometries(frames)
+    for name, backend in BACKENDS:
+        ctx = init_headless_context(size, backend=backend)
+        stages[name] = time_frames(ctx, isoms, lambda: draw.draw_frame(ctx, size, 0.0, rooted))
+
+    # One prototype and one matrix per tile: a view change only
+    # composes the view with the matrices
+    elapsed, tile_instances = time_it(lambda: instances.build_tile_instances(
+        side_num, valence_num, max_length=COXETER_LENGTH_PER_RING * cutoff), repeat)
+    stages['build_tile_instances'] = {'seconds': elapsed,
+                                      'tiles': tile_instances.get_tile_num(),
+                                      'bytes': tile_instances.get_nbytes(),
+                                      'bytes_per_tile': float(tile_instances.get_nbytes()) /
+                                      tile_instances.get_tile_num()}
+    ctx = init_headless_context(size, backend=raster.NumpyBackend())
+    stages['frame_instances'] = time_frames(ctx, isoms,
+                                            lambda: draw_instances_frame(ctx, tile_instances))
+
+    return {'p': side_num, 'q': valence_num, 'cutoff': cutoff, 'stages': stages}
+
+def run(tilings, cutoffs, size, frames, repeat, verbose=True):
+    results = []
+    for side_num, valence_num in tilings:
+        for cutoff in cutoffs:
+            if verbose:
+                print >> sys.stderr, "Benchmarking {%d, %d} with cutoff %d..." % (side_num, valence_num, cutoff),
+            results.append(run_case(side_num, valence_num, cutoff, size, frames, repeat))
+            if verbose:
+                print >> sys.stderr, "done!"
+    return {'meta': {'time': time.time(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'size': list(size),
+                     'frames': frames,
+                     'repeat': repeat},
+            'results': results}
+
+def get_ratio(old, new):
+    """new / old, where nothing is still nothing (1.0) and anything
+    is infinitely more than nothing."""
+    if old > 0:
+        return new / float(old)
+    elif new > 0:
+        return float('inf')
+    else:
+        return 1.0
+
+def compare(baseline, current, threshold):
+    """Print the ratio between current and baseline time for each
+    stage, and return the list of the stages that got slower by more
+    than threshold."""
+    regressions = []
+    baseline_cases = dict(((r['p'], r['q'], r['cutoff']), r) for r in baseline['results'])
+    for result in current['results']:
+        key = (result['p'], result['q'], result['cutoff'])
+        if key not in baseline_cases:
+            continue
+        for stage, data in sorted(result['stages'].iteritems()):
+            if stage not in baseline_cases[key]['stages']:
+                continue
+            old = baseline_cases[key]['stages'][stage]['seconds']
+            ratio = get_ratio(old, data['seconds'])
+            flag = ''
+            if ratio > 1.0 + threshold:
+                flag = ' REGRESSION'
+                regressions.append((key, stage, ratio))
+            print "{%d, %d} cutoff %d %-28s %10.6f -> %10.6f (x%.3f)%s" % \
+                (key[0], key[1], key[2], stage, old, data['seconds'], ratio, flag)
+            for name in TRACKED_COUNTS:
+                if name not in data or name not in baseline_cases[key]['stages'][stage]:
+                    continue
+                old = baseline_cases[key]['stages'][stage][name]
+                ratio = get_ratio(old, data[name])
+                flag = ''
+                if ratio > 1.0 + threshold:
+                    flag = ' REGRESSION'
+                    regressions.append((key, stage + ':' + name, ratio))
+                print "{%d, %d} cutoff %d %-28s %10.1f -> %10.1f (x%.3f)%s" % \
+                    (key[0], key[1], key[2], stage + ':' + name, old, data[name], ratio, flag)
+    return regressions
+
+def parse_tiling(s):
+    p, q = s.split(',')
+    return (int(p), int(q))
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks for Hyperbolic!")
+    parser.add_argument('--tiling', type=parse_tiling, action='append',
+                        help="p,q couple (can be repeated)")
+    parser.add_argument('--cutoff', type=int, action='append',
+                        help="maximum ring depth (can be repeated)")
+    parser.add_argument('--size', type=int, nargs=2, default=list(DEFAULT_SIZE))
+    parser.add_argument('--frames', type=int, default=DEFAULT_FRAMES)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="compare with the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    results = run(args.tiling or DEFAULT_TILINGS, args.cutoff or DEFAULT_CUTOFFS,
+                  tuple(args.size), args.frames, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    elif args.compare is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if args.compare is not None:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        if len(compare(baseline, results, args.threshold)) > 0:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@
 #include <stdio.h>
 #include <math.h>
 
+#define GEODESIC_DIAMETER_EPSILON 1e-12
+
 inline static void swap(double *a, double *b) {
 
   double tmp = *b;
@@ -124,10 +126,203 @@ static PyObject *c_eucircle_intersection_line(PyObject *self, PyObject *args) {
 
 }
 
+/* Batch kernels: they work in place on buffers of doubles (for
+   example contiguous float64 numpy arrays) and release the GIL while
+   running, so that different threads can process different slices of
+   the same array. */
+
+inline static void isometry_map(const double *m, double *x, double *y) {
+
+  double coeff = 1.0 / (m[6] * *x + m[7] * *y + m[8]);
+  double new_x = coeff * (m[0] * *x + m[1] * *y + m[2]);
+  double new_y = coeff * (m[3] * *x + m[4] * *y + m[5]);
+  *x = new_x;
+  *y = new_y;
+
+}
+
+inline static void klein_to_poincare(double *x, double *y) {
+
+  double sqnorm = *x * *x + *y * *y;
+  double mult = 1.0 / (1.0 + sqrt(sqnorm < 1.0 ? 1.0 - sqnorm : 0.0));
+  *x *= mult;
+  *y *= mult;
+
+}
+
+/* Circle through the two points of the Poincaré disc that is
+   orthogonal to the unit circle: its center c satisfies 2 c.p = |p|^2
+   + 1 for both points. If the points are aligned with the origin the
+   geodesic is a diameter and the radius is set to zero. Otherwise the
+   arc goes counterclockwise from angle1 to angle2, both in [0, 2pi). */
+inline static void geodesic_arc(double x1, double y1, double x2, double y2,
+                                double *cx, double *cy, double *r, double *angle1, double *angle2) {
+
+  double det = 2.0 * det2(x1, y1, x2, y2);
+  double k1 = x1*x1 + y1*y1 + 1.0;
+  double k2 = x2*x2 + y2*y2 + 1.0;
+  if (fabs(det) < GEODESIC_DIAMETER_EPSILON) {
+    *cx = *cy = *r = *angle1 = *angle2 = 0.0;
+    return;
+  }
+  *cx = det2(k1, y1, k2, y2) / det;
+  *cy = det2(x1, k1, x2, k2) / det;
+  *r = sqrt(fmax(*cx * *cx + *cy * *cy - 1.0, 0.0));
+  double a1 = atan2(y1 - *cy, x1 - *cx);
+  double a2 = atan2(y2 - *cy, x2 - *cx);
+  if (fmod(a2 - a1 + 4*M_PI, 2*M_PI) > M_PI) {
+    swap(&a1, &a2);
+  }
+  *angle1 = fmod(a1 + 2*M_PI, 2*M_PI);
+  *angle2 = fmod(a2 + 2*M_PI, 2*M_PI);
+
+}
+
+static int check_buffer(Py_buffer *buf, Py_ssize_t item) {
+
+  if (buf->len % (item * sizeof(double)) != 0) {
+    PyErr_SetString(PyExc_ValueError, "buffer size is not a multiple of the item size");
+    PyBuffer_Release(buf);
+    return 0;
+  }
+  return 1;
+
+}
+
+static PyObject *c_isometry_map_array(PyObject *self, PyObject *args) {
+
+  double m[9];
+  Py_buffer buf;
+  if (!PyArg_ParseTuple(args, "dddddddddw*", &m[0], &m[1], &m[2], &m[3], &m[4], &m[5], &m[6], &m[7], &m[8], &buf)) {
+    return NULL;
+  }
+  if (!check_buffer(&buf, 2)) {
+    return NULL;
+  }
+  double *data = (double*) buf.buf;
+  Py_ssize_t num = buf.len / (2 * sizeof(double));
+  Py_ssize_t i;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < num; i++) {
+    isometry_map(m, &data[2*i], &data[2*i+1]);
+  }
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&buf);
+  Py_RETURN_NONE;
+
+}
+
+static PyObject *c_klein_to_poincare_array(PyObject *self, PyObject *args) {
+
+  Py_buffer buf;
+  if (!PyArg_ParseTuple(args, "w*", &buf)) {
+    return NULL;
+  }
+  if (!check_buffer(&buf, 2)) {
+    return NULL;
+  }
+  double *data = (double*) buf.buf;
+  Py_ssize_t num = buf.len / (2 * sizeof(double));
+  Py_ssize_t i;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < num; i++) {
+    klein_to_poincare(&data[2*i], &data[2*i+1]);
+  }
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&buf);
+  Py_RETURN_NONE;
+
+}
+
+static PyObject *c_geodesic_arc_array(PyObject *self, PyObject *args) {
+
+  Py_buffer in, out;
+  if (!PyArg_ParseTuple(args, "s*w*", &in, &out)) {
+    return NULL;
+  }
+  if (in.len % (4 * sizeof(double)) != 0 || out.len != in.len / 4 * 5) {
+    PyErr_SetString(PyExc_ValueError, "expected 4 input and 5 output doubles for each segment");
+    PyBuffer_Release(&in);
+    PyBuffer_Release(&out);
+    return NULL;
+  }
+  const double *src = (const double*) in.buf;
+  double *dst = (double*) out.buf;
+  Py_ssize_t num = in.len / (4 * sizeof(double));
+  Py_ssize_t i;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < num; i++) {
+    geodesic_arc(src[4*i], src[4*i+1], src[4*i+2], src[4*i+3],
+                 &dst[5*i], &dst[5*i+1], &dst[5*i+2], &dst[5*i+3], &dst[5*i+4]);
+  }
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&in);
+  PyBuffer_Release(&out);
+  Py_RETURN_NONE;
+
+}
+
+static PyObject *c_splat_array(PyObject *self, PyObject *args) {
+
+  Py_buffer points, weights, coverage;
+  Py_ssize_t width;
+  double y0;
+  if (!PyArg_ParseTuple(args, "s*s*w*nd", &points, &weights, &coverage, &width, &y0)) {
+    return NULL;
+  }
+  if (points.len != 2 * weights.len || width <= 0 || coverage.len % (width * sizeof(double)) != 0) {
+    PyErr_SetString(PyExc_ValueError, "expected 2 point and 1 weight doubles for each sample, and a whole number of coverage rows");
+    PyBuffer_Release(&points);
+    PyBuffer_Release(&weights);
+    PyBuffer_Release(&coverage);
+    return NULL;
+  }
+  const double *src = (const double*) points.buf;
+  const double *w = (const double*) weights.buf;
+  double *dst = (double*) coverage.buf;
+  Py_ssize_t num = weights.len / sizeof(double);
+  Py_ssize_t height = coverage.len / (width * sizeof(double));
+  Py_ssize_t i;
+  Py_BEGIN_ALLOW_THREADS
+  for (i = 0; i < num; i++) {
+    // Pixel centers are at half integer coordinates
+    double x = src[2*i] - 0.5;
+    double y = src[2*i+1] - y0 - 0.5;
+    double bx = floor(x);
+    double by = floor(y);
+    // Skip samples far outside, before converting to integers
+    if (bx < -1.0 || bx >= width || by < -1.0 || by >= height) {
+      continue;
+    }
+    double fx = x - bx;
+    double fy = y - by;
+    Py_ssize_t px = (Py_ssize_t) bx;
+    Py_ssize_t py = (Py_ssize_t) by;
+    if (py >= 0) {
+      if (px >= 0) dst[py * width + px] += w[i] * (1.0 - fx) * (1.0 - fy);
+      if (px + 1 < width) dst[py * width + px + 1] += w[i] * fx * (1.0 - fy);
+    }
+    if (py + 1 < height) {
+      if (px >= 0) dst[(py + 1) * width + px] += w[i] * (1.0 - fx) * fy;
+      if (px + 1 < width) dst[(py + 1) * width + px + 1] += w[i] * fx * fy;
+    }
+  }
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&points);
+  PyBuffer_Release(&weights);
+  PyBuffer_Release(&coverage);
+  Py_RETURN_NONE;
+
+}
+
 static PyMethodDef ChyperbolicMethods[] = {
   {"c_eupoint_line_to", c_eupoint_line_to, METH_VARARGS, ""},
   {"c_euline_intersection_line", c_euline_intersection_line, METH_VARARGS, ""},
   {"c_eucircle_intersection_line", c_eucircle_intersection_line, METH_VARARGS, ""},
+  {"c_isometry_map_array", c_isometry_map_array, METH_VARARGS, ""},
+  {"c_klein_to_poincare_array", c_klein_to_poincare_array, METH_VARARGS, ""},
+  {"c_geodesic_arc_array", c_geodesic_arc_array, METH_VARARGS, ""},
+  {"c_splat_array", c_splat_array, METH_VARARGS, ""},
   {NULL, NULL, 0, NULL}
 };
 
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Generate regular tessellations as orbits of the (2, p, q) triangle
+reflection group.
+
+The fundamental triangle has its vertices in the center O of the
+central polygon, in the midpoint M of one of its sides and in one of
+its vertices V. The group is generated by the reflections a (along
+OM), b (along OV) and c (along MV); the stabilizer of the central
+polygon is generated by a and b, so tiles are in bijection with the
+elements of the group that are minimal in their coset modulo <a, b>,
+i.e. that have no right descents in {a, b}.
+
+Each tile is produced exactly once by walking the tree in which the
+parent of u is s u, with s the smallest left descent of u. Descents
+are computed with the sign of roots in the Tits representation, so no
+geometric comparison between tiles is needed."""
+
+import math
+
+from hyperbolic import Point, Isometry
+from polygons import get_radius_from_angle, FAR_FIELD_EPSILON
+
+GENERATORS = 'abc'
+
+def get_coxeter_matrix(side_num, valence_num):
+    return [[1, side_num, 2],
+            [side_num, 1, valence_num],
+            [2, valence_num, 1]]
+
+def mat_mult(m1, m2):
+    (a, b, c), (d, e, f), (g, h, i) = m1
+    (A, B, C), (D, E, F), (G, H, I) = m2
+    return ((a*A + b*D + c*G, a*B + b*E + c*H, a*C + b*F + c*I),
+            (d*A + e*D + f*G, d*B + e*E + f*H, d*C + e*F + f*I),
+            (g*A + h*D + i*G, g*B + h*E + i*H, g*C + h*F + i*I))
+
+IDENTITY = ((1.0, 0.0, 0.0),
+            (0.0, 1.0, 0.0),
+            (0.0, 0.0, 1.0))
+
+def get_tits_generators(side_num, valence_num):
+    """The matrices of the three generators in the Tits (geometric)
+    representation: s_i(alpha_j) = alpha_j - 2 B(alpha_i, alpha_j)
+    alpha_i."""
+    coxeter = get_coxeter_matrix(side_num, valence_num)
+    bilinear = [[-math.cos(math.pi / coxeter[i][j]) for j in xrange(3)] for i in xrange(3)]
+    gens = []
+    for i in xrange(3):
+        m = [list(row) for row in IDENTITY]
+        for j in xrange(3):
+            m[i][j] -= 2.0 * bilinear[i][j]
+        gens.append(tuple(map(tuple, m)))
+    return gens
+
+def is_negative_column(m, j):
+    """Roots are either positive or negative combinations of simple
+    roots, so the sign of the sum of the coefficients is enough."""
+    return m[0][j] + m[1][j] + m[2][j] < 0.0
+
+def get_fundamental_polygon(side_num, valence_num):
+    """The vertices of the central polygon, centered in the origin
+    and with its first vertex on the positive x axis."""
+    radius = get_radius_from_angle(side_num, 2.0 * math.pi / float(valence_num))
+    r = math.tanh(radius)
+    return [Point(r * math.cos(2.0 * math.pi * k / side_num),
+                  r * math.sin(2.0 * math.pi * k / side_num))
+            for k in xrange(side_num)]
+
+def get_reflections(side_num, valence_num):
+    """The isometries of the generators a, b and c."""
+    vertices = get_fundamental_polygon(side_num, valence_num)
+    center = Point(0.0, 0.0)
+    middle = Point(0.5 * (vertices[0].x + vertices[1].x),
+                   0.5 * (vertices[0].y + vertices[1].y))
+    return [Isometry.reflection(center.line_to(middle)),
+            Isometry.reflection(center.line_to(vertices[0])),
+            Isometry.reflection(vertices[0].line_to(vertices[1]))]
+
+def iter_coxeter_tessellation(side_num, valence_num, pv=None, max_length=None,
+                              max_tiles=None, max_radius=None):
+    """Generate the tiles of the {side_num, valence_num} tessellation
+    by increasing word length, yielding (word, isometry) couples. The
+    isometry maps the fundamental polygon (see
+    get_fundamental_polygon()) to the tile; if pv is given, the whole
+    tessellation is moved so that the origin goes to pv.
+
+    Tiles whose center is farther than max_radius from the center of
+    the central tile are not generated. A tile is not expanded further
+    if all its vertices are in the far field or if its word is
+    max_length letters long (in both cases its descendants would be
+    farther too)."""
+    if (side_num - 2) * (valence_num - 2) <= 4:
+        raise Exception("{%d, %d} is not a hyperbolic tessellation" % (side_num, valence_num))
+
+    tits = get_tits_generators(side_num, valence_num)
+    reflections = get_reflections(side_num, valence_num)
+    vertices = get_fundamental_polygon(side_num, valence_num)
+    base = Isometry() if pv is None else pv.get_isometry()
+    origin = Point(0.0, 0.0)
+
+    # Each element is (word, sigma(u), sigma(u^-1), isometry)
+    level = [('', IDENTITY, IDENTITY, Isometry())]
+    tiles = 0
+    length = 0
+    while len(level) > 0:
+        next_level = []
+        for word, sigma, sigma_inv, isom in level:
+            if max_tiles is not None and tiles >= max_tiles:
+                return
+            # Tiles farther than max_radius are not generated, like in
+            # polygons.iter_regular_tessellation()
+            center = isom.map(origin)
+            if max_radius is not None and \
+                    math.atanh(min(center.to_eupoint().norm(), 1.0 - 1e-16)) > max_radius:
+                continue
+            tile_isom = base.compose(isom)
+            tiles += 1
+            yield word, tile_isom
+
+            if max_length is not None and length >= max_length:
+                continue
+            if min(map(lambda p: isom.map(p).to_eupoint().sqnorm(), vertices)) > \
+                    1.0 - FAR_FIELD_EPSILON:
+                continue
+
+            for s in xrange(3):
+                # s must not shorten v...
+                if is_negative_column(sigma_inv, s):
+                    continue
+                new_sigma = mat_mult(tits[s], sigma)
+                # ...u = s v must be minimal in its coset...
+                if is_negative_column(new_sigma, 0) or is_negative_column(new_sigma, 1):
+                    continue
+                # ...and s must be the smallest left descent of u
+                new_sigma_inv = mat_mult(sigma_inv, tits[s])
+                if any(is_negative_column(new_sigma_inv, t) for t in xrange(s)):
+                    continue
+                next_level.append((GENERATORS[s] + word, new_sigma, new_sigma_inv,
+                                   reflections[s].compose(isom)))
+        level = next_level
+        length += 1
+
+def get_element(word, tits):
+    """The (sigma(u), sigma(u^-1)) couple of the Tits matrices of the
+    element u spelled by word."""
+    sigma, sigma_inv = IDENTITY, IDENTITY
+    for letter in word:
+        s = GENERATORS.index(letter)
+        sigma = mat_mult(sigma, tits[s])
+        sigma_inv = mat_mult(tits[s], sigma_inv)
+    return sigma, sigma_inv
+
+def get_tile_word(sigma, sigma_inv, tits):
+    """The word with which iter_coxeter_tessellation() yields the tile
+    of the element u: u is first brought down to the minimal element
+    of its coset modulo <a, b>, then its smallest left descents are
+    stripped one at a time."""
+    while True:
+        for s in xrange(2):
+            if is_negative_column(sigma, s):
+                sigma = mat_mult(sigma, tits[s])
+                sigma_inv = mat_mult(tits[s], sigma_inv)
+                break
+        else:
+            break
+    # Left descents only depend on sigma(u^-1)
+    word = ''
+    while True:
+        for s in xrange(3):
+            if is_negative_column(sigma_inv, s):
+                word += GENERATORS[s]
+                sigma_inv = mat_mult(sigma_inv, tits[s])
+                break
+        else:
+            return word
+
+def get_side_elements(side_num, tits):
+    """For each side k of the fundamental polygon, the Tits matrices
+    of (ab)^k c, which maps the central tile to the one across side k:
+    ab rotates the polygon by one side and c reflects it along side
+    0."""
+    return [get_element('ab' * k + 'c', tits) for k in xrange(side_num)]
+
+def get_neighbor_word(element, side_element, tits):
+    """The word of the tile across a side of the tile of element (both
+    given as (sigma(u), sigma(u^-1)) couples, the latter as returned by
+    get_side_elements())."""
+    sigma, sigma_inv = element
+    side_sigma, side_sigma_inv = side_element
+    return get_tile_word(mat_mult(sigma, side_sigma), mat_mult(side_sigma_inv, sigma_inv), tits)
+
+def get_tile_points(side_num, valence_num, word, isom, vertices=None):
+    """The vertices of a tile, counterclockwise."""
+    if vertices is None:
+        vertices = get_fundamental_polygon(side_num, valence_num)
+    points = [isom.map(p) for p in vertices]
+    # Orientation reversing isometries reverse the order of the
+    # vertices
+    if len(word) % 2 == 1:
+        points.reverse()
+    return points
+
+def build_coxeter_tessellation(side_num, valence_num, pv=None, max_length=None,
+                               max_tiles=None, max_radius=None):
+    """Same format as polygons.build_regular_tessellation(), except
+    that vertices are Points instead of PointedVectors."""
+    vertices = get_fundamental_polygon(side_num, valence_num)
+    return [get_tile_points(side_num, valence_num, word, isom, vertices=vertices)
+            for word, isom in iter_coxeter_tessellation(side_num, valence_num, pv=pv,
+                                                        max_length=max_length,
+                                                        max_tiles=max_tiles,
+                                                        max_radius=max_radius)]
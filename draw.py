@@ -1,32 +1,73 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import math
+import time
+import multiprocessing
+
+# Time to first frame is measured from here
+START_TIME = time.time()
 
 #import pygst
 #pygst.require("0.10")
 #import gst
 #import pygtk
 #import gtk
-import cairo as cairolib
-import Image
-import ImageDraw
 
-import pygame
-import pygame.gfxdraw
-from pygame.locals import *
+# cairo, PIL and pygame are only imported by the functions that use
+# them, so that importing this module is quick and the viewer window
+# shows up before they are loaded
 
 import euclidean
 import hyperbolic
 import teichmuller
 import polygons
+import mesh
+import instances
+import spatial
+import panning
+import sinks
+import profiling
+import raster
+import rendering
+import tessellation_store
 from utils import get_actual_dimension
 
-tessellation = polygons.build_regular_tessellation(5, 5, hyperbolic.PointedVector(0.0, 0.0, 0.0))
-segments = polygons.build_segment_list(tessellation)
+#tessellation = polygons.build_regular_tessellation(5, 5, hyperbolic.PointedVector(0.0, 0.0, 0.0))
+#tessellation_mesh = mesh.build_mesh(tessellation)
+#tessellation_index = spatial.EdgeIndex(tessellation_mesh.get_segment_array())
+#tessellation_instances = instances.build_tile_instances(5, 5)
+TESSELLATION = (5, 5)
+
+# The tessellation is not built at import: load_tessellation() builds
+# it (or loads it from the store) at once, while the viewer builds it
+# in the background and meanwhile shows bigger and bigger parts of it
+tessellation = None
+
+def get_tessellation_store():
+    return tessellation_store.TessellationStore(modules=[panning])
+
+def load_tessellation():
+    global tessellation
+    if tessellation is None:
+        tessellation = panning.RootedTessellation(*TESSELLATION, store=get_tessellation_store())
+    return tessellation
+
+# Set to True when draw_frame() draws something that depends on param
+# (like the moving isometry commented out below); otherwise frames
+# that only differ in param are the same and are not drawn again
+ANIMATED = False
 
-def draw_frame(ctx, size, param):
+def get_render_key(isom, poincare, backend, size, param, tessellation):
+    """Everything the picture drawn by draw_frame() depends on."""
+    return (isom, poincare, backend, size, param if ANIMATED else None, tessellation)
+
+def draw_frame(ctx, size, param, tessellation):
+
+    ctx.size = size
+    ctx.cull_stats.reset()
 
     #pv = hyperbolic.PointedVector(param * 0.05 - 0.7, param * 0.04 - 0.7, param * 0.1 * math.pi)
     #pv = hyperbolic.PointedVector(0.0, 0.0, 0.0)
@@ -47,7 +88,8 @@ def draw_frame(ctx, size, param):
     # ctx.cairo.restore()
 
     # Everything white
-    ctx.image_draw.rectangle([(0, 0), size], fill=(255, 255, 255))
+    with profiling.stage(ctx.profiler, 'clear'):
+        ctx.backend.clear(ctx, (255, 255, 255))
 
     #ctx.image_draw.rectangle([(10, 10), (200, 200)], fill=(128, 0, 0))
 
@@ -71,7 +113,15 @@ def draw_frame(ctx, size, param):
     #polygons.draw_polygon(ctx, polygons.build_polygon_with_center(5, 2.0, turtle))
     #polygons.draw_polygon(ctx, polygons.build_polygon_with_angle(7, 2.0 * math.pi / 3, turtle))
     #polygons.draw_polygons(ctx, tessellation)
-    polygons.draw_segments(ctx, segments)
+    #polygons.draw_segments(ctx, segments)
+    #mesh.draw_mesh(ctx, tessellation_mesh, index=tessellation_index)
+    #instances.draw_instances(ctx, tessellation_instances)
+    # Until the first part of the tessellation is built, there is only
+    # the disc
+    if tessellation is not None:
+        tessellation.draw(ctx)
+    with profiling.stage(ctx.profiler, 'rasterization'):
+        ctx.backend.finish(ctx)
 
     #hyperbolic.Point(0.0, 0.0).segment_to(hyperbolic.Point(0.5, 0.0)).draw(ctx)
     #hyperbolic.Point(0.0, 0.0).draw(ctx)
@@ -81,9 +131,7 @@ def draw_frame(ctx, size, param):
     #ctx.cairo.arc(0, 0, 1, 0, 2 * math.pi)
     #ctx.cairo.set_source_rgb(0, 0, 0)
     #ctx.cairo.stroke()
-    p1 = tuple(map(int, ctx.cairo.user_to_device(-1.0, 1.0)))
-    p2 = tuple(map(int, ctx.cairo.user_to_device(1.0, -1.0)))
-    ctx.image_draw.arc([p1[0], p1[1], p2[0], p2[1]], 0, 360, fill=(255, 0, 0))
+    ctx.backend.draw_circle(ctx, 0.0, 0.0, 1.0, (255, 0, 0))
 
 def draw_overlay(overlay, ctx, timestamp, duration):
 
@@ -120,16 +168,31 @@ def gtk_animation():
 
     gtk.main()
 
-def init_cairo(size):
+def init_display(size):
+    import pygame
 
     #pygame_surf = pygame.display.set_mode(size, pygame.FULLSCREEN, 32)
     #size = pygame_surf.get_size()
     pygame_surf = pygame.display.set_mode(size, pygame.RESIZABLE, 32)
-    cairo_surf = cairolib.ImageSurface.create_for_data(
-        pygame.surfarray.pixels2d(pygame_surf),
-        cairolib.FORMAT_RGB24,
-        size[0],
-        size[1])
+
+    return pygame_surf
+
+def init_cairo(size, frame_data=None):
+    import cairo as cairolib
+
+    # Cairo draws into the frame buffer as well: wrapping the display
+    # surface itself would keep it locked, and nothing could be
+    # blitted on it (hyperbolic.CairoBackend takes care of the byte
+    # order); without a frame buffer the context is only good for
+    # converting coordinates
+    if frame_data is not None:
+        cairo_surf = cairolib.ImageSurface.create_for_data(
+            frame_data,
+            cairolib.FORMAT_ARGB32,
+            size[0],
+            size[1])
+    else:
+        cairo_surf = cairolib.ImageSurface(cairolib.FORMAT_ARGB32, 1, 1)
 
     # Inizialize cairo context
     cairo = cairolib.Context(cairo_surf)
@@ -141,15 +204,80 @@ def init_cairo(size):
     cairo.translate(size[0]/2, -size[1]/2)
     cairo.scale(versor_len, versor_len)
 
-    return pygame_surf, cairo
+    return cairo
 
-def init_pil(size):
+def init_pil(size, frame_data=None):
+    """Return a frame buffer (a new one, unless it is given) and a PIL
+    image that uses it as its memory, so that a cairo surface can
+    share it."""
+    import Image
+    import ImageDraw
 
     #pygame_surf = pygame.display.set_mode(size, pygame.RESIZABLE, 32)
-    pil_image = Image.new("RGBA", size)
+    if frame_data is None:
+        frame_data = bytearray(4 * size[0] * size[1])
+    pil_image = Image.frombuffer("RGBA", size, frame_data, 'raw', 'RGBA', 0, 1)
+    # Mapped images are marked read only, and ImageDraw would silently
+    # draw on a copy
+    pil_image.readonly = 0
     pil_image_draw = ImageDraw.Draw(pil_image)
 
-    return pil_image, pil_image_draw
+    return frame_data, pil_image, pil_image_draw
+
+def init_framebuffer(size):
+    """Return a frame buffer and a pygame surface sharing it, so that
+    what is drawn on it (by cairo, numpy or a PIL image created with
+    init_pil()) can be blitted on the display without any intermediate
+    copy."""
+    import pygame
+
+    frame_data = bytearray(4 * size[0] * size[1])
+    frame_surf = pygame.image.frombuffer(frame_data, size, 'RGBX')
+
+    return frame_data, frame_surf
+
+class View:
+    """What the render thread is asked to draw."""
+
+    def __init__(self, isom, poincare, backend, size, param, tessellation):
+        self.isom = isom
+        self.poincare = poincare
+        self.backend = backend
+        self.size = size
+        self.param = param
+        self.tessellation = tessellation
+
+    def get_key(self):
+        return get_render_key(self.isom, self.poincare, self.backend, self.size, self.param,
+                              self.tessellation)
+
+def init_render_buffer(size):
+    """A context drawing on its own frame buffer, and the pygame
+    surface sharing it. The PIL image is only created (see draw_view())
+    when a hyperbolic.PilBackend needs it."""
+    frame_data, frame_surf = init_framebuffer(size)
+    ctx = hyperbolic.HyperbolicContext(init_cairo(size, frame_data), hyperbolic.MobiusIsometry(),
+                                       poincare=True, size=size)
+    ctx.frame_data = frame_data
+    ctx.image, ctx.image_draw = None, None
+    ctx.pixels = raster.get_pixels(frame_data, size)
+    ctx.view = None
+    return ctx, frame_surf
+
+def draw_view(render_buffer, view, profiler=None):
+    ctx, frame_surf = render_buffer
+    ctx.isom = view.isom
+    ctx.poincare = view.poincare
+    ctx.backend = view.backend
+    ctx.profiler = profiler
+    ctx.view = view
+    if isinstance(ctx.backend, hyperbolic.PilBackend) and ctx.image is None:
+        _, ctx.image, ctx.image_draw = init_pil(view.size, ctx.frame_data)
+    if profiler is not None:
+        profiler.start_frame()
+    draw_frame(ctx, view.size, view.param, view.tessellation)
+    if profiler is not None:
+        profiler.end_frame()
 
 def get_mouse_coords(ctx, event):
     user_coords = ctx.cairo.device_to_user(*event.pos)
@@ -161,7 +289,44 @@ def get_mouse_coords(ctx, event):
     else:
         return (None, None)
 
+PROFILE_PATTERN = 'profile-%s-%s.csv'
+PROFILE_FONT_SIZE = 20
+PROFILE_FRAMES = 30
+DISPLAY_FPS = 60
+
+def draw_profile_overlay(surface, font, profilers, ctx, renderer):
+    lines = []
+    for name, profiler in profilers:
+        lines.append("%s fps: %.1f" % (name, profiler.get_fps(PROFILE_FRAMES)))
+        for stage, duration in profiler.get_averages(PROFILE_FRAMES).iteritems():
+            lines.append("  %s: %.2f ms" % (stage, 1000.0 * duration))
+    lines.append("segments: %d drawn, %d culled" % (ctx.cull_stats.drawn, ctx.cull_stats.get_culled()))
+    lines.append("frames: %d rendered, %d dropped" % (renderer.rendered, renderer.dropped))
+    y = 5
+    for line in lines:
+        text = font.render(line, True, (0, 0, 255))
+        surface.blit(text, (5, y))
+        y += text.get_height()
+
+def drag_view(ctx, event, base_point, base_isom):
+    """Move the view so that base_point, where the drag started with
+    view base_isom, is under the mouse; return the new base_isom."""
+    x, y = get_mouse_coords(ctx, event)
+    if x is not None:
+        trans = hyperbolic.MobiusIsometry.translation(base_point[0], base_point[1], x, y)
+        ctx.isom = trans.compose(base_isom)
+        if tessellation is not None:
+            ctx.isom, symmetry = tessellation.rebase(ctx.isom)
+            if symmetry is not None:
+                base_isom = base_isom.compose(symmetry)
+    return base_isom
+
+def report_time(what):
+    print "%s %.3f s after start" % (what, time.time() - START_TIME)
+
 def pygame_animation():
+    global tessellation
+    import pygame
 
     #math.mp.prec = 500
 
@@ -170,94 +335,197 @@ def pygame_animation():
     fpsClock = pygame.time.Clock()
     pygame.display.set_caption('Hyperbolic!')
 
+    # This context only holds the view and converts mouse coordinates;
+    # frames are drawn by the render thread on contexts of its own
     size = (640, 480)
-    pygame_surf, cairo = init_cairo(size)
-    image, image_draw = init_pil(size)
-    ctx = hyperbolic.HyperbolicContext(cairo, hyperbolic.Isometry(), poincare=True)
-    ctx.image, ctx.image_draw = image, image_draw
+    pygame_surf = init_display(size)
+    ctx = hyperbolic.HyperbolicContext(init_cairo(size), hyperbolic.MobiusIsometry(), poincare=True)
+
+    # The tessellation grows in the background; each part of it is
+    # drawn as soon as it is ready
+    tessellations = rendering.Mailbox()
+    tessellation_version = 0
+    builder = rendering.BackgroundBuilder(
+        panning.iter_progressive_tessellations(*TESSELLATION, store=get_tessellation_store()),
+        tessellations)
+    builder.start()
+    first_frame = True
+    shown_tessellation = None
+
+    # Profiling
+    profiler = profiling.FrameProfiler()
+    render_profiler = profiling.FrameProfiler()
+    font = pygame.font.Font(None, PROFILE_FONT_SIZE)
+    show_profile = False
+
+    views = rendering.Mailbox()
+    changes = rendering.ChangeTracker()
+    renderer = rendering.RenderThread(views, init_render_buffer,
+                                      lambda buf, view: draw_view(buf, view, render_profiler))
+    renderer.start()
 
     # Movement tracking
     base_point = None
     base_isom = None
 
+    # Whether the display has to be blitted again even if there is no
+    # new frame
+    display_dirty = True
+
     while True:
+        profiler.start_frame()
         param = 0.001 * pygame.time.get_ticks()
         #param = 10.0
 
-        draw_frame(ctx, size, param)
-
-        # Process events
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-
-            elif event.type == KEYDOWN:
-                if event.key == K_ESCAPE:
-                    pygame.event.post(pygame.event.Event(QUIT))
-
-                if event.key == K_m:
-                    ctx.poincare = not ctx.poincare
-
-            elif event.type == VIDEORESIZE:
-                size = event.size
-                cairo = init_cairo(size)
-                image_draw = init_pil(size)
-                ctx.cairo = cairo
-                ctx.image_draw = image_draw
-
-            elif event.type == MOUSEBUTTONDOWN:
-                x, y = get_mouse_coords(ctx, event)
-                if x is not None:
-
-                    # First button
-                    if event.button == 1:
-                        base_point = (x, y)
-                        base_isom = ctx.isom
-
-            elif event.type == MOUSEMOTION:
-                x, y = get_mouse_coords(ctx, event)
-                if x is not None:
-
+        if builder.error is not None:
+            raise builder.error
+        tessellation_version, latest = tessellations.get(tessellation_version, timeout=0.0)
+        if latest is not None:
+            tessellation = latest
+
+        # Process events; of the motion events between two frames
+        # only the last one counts, as dragging does not depend on the
+        # intermediate positions
+        motion = None
+        with profiling.stage(profiler, 'events'):
+            for event in pygame.event.get():
+                if motion is not None and \
+                        event.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP):
+                    with profiling.stage(profiler, 'isometry'):
+                        base_isom = drag_view(ctx, motion, base_point, base_isom)
+                    motion = None
+
+                if event.type == pygame.QUIT:
+                    renderer.stop()
+                    pygame.quit()
+                    sys.exit()
+
+                elif event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+                    if event.key == pygame.K_m:
+                        ctx.poincare = not ctx.poincare
+
+                    if event.key == pygame.K_b:
+                        if isinstance(ctx.backend, hyperbolic.PilBackend):
+                            ctx.backend = hyperbolic.CairoBackend()
+                        elif isinstance(ctx.backend, hyperbolic.CairoBackend):
+                            ctx.backend = raster.NumpyBackend()
+                        elif not isinstance(ctx.backend, raster.BandedBackend):
+                            ctx.backend = raster.BandedBackend()
+                        else:
+                            ctx.backend = hyperbolic.PilBackend()
+                        print "Drawing with %r" % (ctx.backend)
+
+                    if event.key == pygame.K_p:
+                        show_profile = not show_profile
+                        display_dirty = True
+
+                    if event.key == pygame.K_r:
+                        changes.force()
+
+                    if event.key == pygame.K_d:
+                        timestamp = time.strftime('%Y%m%d-%H%M%S')
+                        for name, prof in [('display', profiler), ('render', render_profiler)]:
+                            path = PROFILE_PATTERN % (timestamp, name)
+                            prof.dump_csv(path)
+                            print "Profile written to %s" % (path)
+
+                elif event.type == pygame.VIDEORESIZE:
+                    size = event.size
+                    pygame_surf = init_display(size)
+                    ctx.cairo = init_cairo(size)
+                    display_dirty = True
+
+                elif event.type == pygame.MOUSEBUTTONDOWN:
+                    x, y = get_mouse_coords(ctx, event)
+                    if x is not None:
+
+                        # First button
+                        if event.button == 1:
+                            base_point = (x, y)
+                            base_isom = ctx.isom
+
+                elif event.type == pygame.MOUSEMOTION:
                     if base_point is not None:
-                        trans = hyperbolic.Isometry.translation(base_point[0], base_point[1], x, y)
-                        ctx.isom = trans.compose(base_isom)
-
-            elif event.type == MOUSEBUTTONUP:
-                x, y = get_mouse_coords(ctx, event)
-                if x is not None:
-                    rot = None
-
-                    # First button
-                    if event.button == 1:
-                        base_point = None
-                        base_isom = None
-
-                    # Scroll up
-                    if event.button == 4:
-                        rot = hyperbolic.Isometry.rotation(x, y, 0.1)
-
-                    # Scroll down
-                    elif event.button == 5:
-                        rot = hyperbolic.Isometry.rotation(x, y, -0.1)
-
-                    if rot is not None:
-                        ctx.isom = rot.compose(ctx.isom)
-
-        new_surface = pygame.image.frombuffer(ctx.image.tostring('raw', 'RGBA', 0, 1), size, 'RGBA')
-        pygame_surf.blit(new_surface, (0, 0))
+                        motion = event
+
+                elif event.type == pygame.MOUSEBUTTONUP:
+                    x, y = get_mouse_coords(ctx, event)
+                    if x is not None:
+                        rot = None
+
+                        # First button
+                        if event.button == 1:
+                            base_point = None
+                            base_isom = None
+
+                        # Scroll up
+                        if event.button == 4:
+                            rot = hyperbolic.MobiusIsometry.rotation(x, y, 0.1)
+
+                        # Scroll down
+                        elif event.button == 5:
+                            rot = hyperbolic.MobiusIsometry.rotation(x, y, -0.1)
+
+                        if rot is not None:
+                            with profiling.stage(profiler, 'isometry'):
+                                ctx.isom = rot.compose(ctx.isom)
+                                if tessellation is not None:
+                                    ctx.isom, symmetry = tessellation.rebase(ctx.isom)
+
+            if motion is not None:
+                with profiling.stage(profiler, 'isometry'):
+                    base_isom = drag_view(ctx, motion, base_point, base_isom)
+
+        # The render thread draws the latest view as soon as it is
+        # done with the previous one; nothing is posted (and the
+        # thread sleeps) while the view does not change
+        view = View(ctx.isom, ctx.poincare, ctx.backend, size, param, tessellation)
+        if changes.check(view.get_key()):
+            views.put(view)
+
+        # The overlay changes at every frame
+        with profiling.stage(profiler, 'blit'):
+            with renderer.front_buffer() as (render_buffer, new):
+                flip = render_buffer is not None and (new or display_dirty or show_profile)
+                if flip:
+                    render_ctx, frame_surf = render_buffer
+                    pygame_surf.blit(frame_surf, (0, 0))
+                    # Report when the first frame, and then each part
+                    # of the tessellation, gets to the display
+                    if new and (first_frame or render_ctx.view.tessellation is not shown_tessellation):
+                        shown_tessellation = render_ctx.view.tessellation
+                        report_time("%s with %d tiles shown" % (
+                            "First frame" if first_frame else "Frame",
+                            shown_tessellation.get_tile_num() if shown_tessellation is not None else 0))
+                        first_frame = False
+                    if show_profile:
+                        draw_profile_overlay(pygame_surf, font, [('display', profiler),
+                                                                 ('render', render_profiler)],
+                                             render_ctx, renderer)
+                    display_dirty = False
 
         # Finish
-        pygame.display.flip()
-        fpsClock.tick(30)
-
-def save_frames():
-    fps = 30
-    length = 40
-    frames = int(fps * length)
-    size = (1920, 1080)
-    cairo_surf = cairolib.ImageSurface(
-        cairolib.FORMAT_RGB24,
+        if flip:
+            with profiling.stage(profiler, 'flip'):
+                pygame.display.flip()
+        with profiling.stage(profiler, 'wait'):
+            fpsClock.tick(DISPLAY_FPS)
+        profiler.end_frame()
+
+SAVE_FPS = 30
+SAVE_LENGTH = 40
+SAVE_SIZE = (1920, 1080)
+FRAME_PATTERN = 'frames/frame_%05d.png'
+
+def init_offline_context(size, backend=None):
+    import cairo as cairolib
+    frame_data, image, image_draw = init_pil(size)
+    cairo_surf = cairolib.ImageSurface.create_for_data(
+        frame_data,
+        cairolib.FORMAT_ARGB32,
         size[0],
         size[1])
 
@@ -275,20 +543,107 @@ def save_frames():
     cairo.set_line_join(cairolib.LINE_JOIN_ROUND)
     cairo.set_line_cap(cairolib.LINE_CAP_ROUND)
 
-    ctx = hyperbolic.HyperbolicContext(cairo, hyperbolic.Isometry(), poincare=True)
-
-    for frame in xrange(frames):
-        print "Writing frame %d..." % (frame),
-
-        # Draw the frame
-        param = float(frame) / fps
-        draw_frame(ctx, size, param)
-
-        # Write it to a file
-        with open('frames/frame_%05d.png' % (frame), 'w') as fout:
-            cairo_surf.write_to_png(fout)
-
-        print "done!"
+    ctx = hyperbolic.HyperbolicContext(cairo, hyperbolic.Isometry(), poincare=True, backend=backend)
+    ctx.image, ctx.image_draw = image, image_draw
+    ctx.pixels = raster.get_pixels(frame_data, size)
+
+    return ctx
+
+def get_frame_param(frame, fps):
+    return float(frame) / fps
+
+def render_frame(ctx, size, frame, fps):
+    param = get_frame_param(frame, fps)
+    draw_frame(ctx, size, param, load_tessellation())
+    return ctx.image
+
+worker_ctx = None
+
+def init_frame_worker(size, backend=None):
+    global worker_ctx
+    worker_ctx = init_offline_context(size, backend=backend)
+
+def render_frame_worker(args):
+    frame, size, fps = args
+    return frame, render_frame(worker_ctx, size, frame, fps).tostring()
+
+def save_frames(processes=None, resume=False, pattern=FRAME_PATTERN, sink=None, backend=None,
+                force=False):
+    """Render the animation and pass it to sink (by default, a
+    sinks.PngFrameSink writing to pattern). Frames are rendered by a
+    pool of processes (one per CPU if processes is None, none at all
+    if it is 1), which are forked after the tessellation has been
+    built and thus share it read-only; frames are passed to the sink
+    in order by this process. With resume, frames that the sink
+    already has are not rendered again. backend is passed to the
+    hyperbolic.HyperbolicContext of each process. Frames that would
+    be the same as the previous one (see ANIMATED) are not rendered,
+    but the previous image is written again, unless force is given."""
+    import Image
+    fps = SAVE_FPS
+    length = SAVE_LENGTH
+    frames = int(fps * length)
+    size = SAVE_SIZE
+    if sink is None:
+        sink = sinks.PngFrameSink(pattern)
+
+    todo = [frame for frame in xrange(frames)
+            if not (resume and sink.has_frame(frame))]
+    if resume:
+        print "Skipping %d frames already on disk" % (frames - len(todo))
+
+    # Built before forking the pool, which then shares it
+    load_tessellation()
+
+    # The offline view only changes through param
+    changes = rendering.ChangeTracker()
+    to_render = []
+    for frame in todo:
+        if force:
+            changes.force()
+        if changes.check(get_render_key(None, True, backend, size, get_frame_param(frame, fps),
+                                        tessellation)):
+            to_render.append(frame)
+    print "Rendering %d frames, reusing %d" % (len(to_render), len(todo) - len(to_render))
+
+    pool = None
+    if processes == 1:
+        init_frame_worker(size, backend)
+        results = ((frame, render_frame(worker_ctx, size, frame, fps).copy()) for frame in to_render)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_frame_worker, initargs=(size, backend))
+        results = ((frame, Image.fromstring('RGBA', size, data)) for frame, data in
+                   pool.imap(render_frame_worker, [(frame, size, fps) for frame in to_render]))
+
+    to_render = set(to_render)
+    image = None
+    done = False
+    try:
+        for frame in todo:
+            if frame in to_render:
+                rendered, image = results.next()
+                assert rendered == frame
+            print "Writing frame %d (queue depth %d)..." % (frame, sink.get_queue_depth()),
+            sink.write(frame, image)
+            print "done!"
+        done = True
+    finally:
+        # If rendering or writing failed, neither the workers nor the
+        # writer threads must be left running
+        if pool is not None:
+            if done:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        if not done:
+            try:
+                sink.close()
+            except Exception:
+                # The error being raised is the one worth reporting
+                pass
+    sink.close()
+    print sink.stats
 
 if __name__ == '__main__':
     pygame_animation()
@@ -23,7 +23,9 @@ def solve_poly2(a, b, c):
 def crossratio(a, b, c, d):
     return math.sqrt((a.sqdistance(c) * b.sqdistance(d)) / (a.sqdistance(d) * b.sqdistance(c)))
 
-class EuPoint:
+class EuPoint(object):
+
+    __slots__ = ('x', 'y')
 
     def __init__(self, x, y):
         self.x = x
@@ -45,10 +47,13 @@ class EuPoint:
         return EuPoint(coeff * self.x, coeff * self.y)
 
     def normalize(self):
-        return self.multiply(1.0 / self.norm())
+        coeff = 1.0 / math.sqrt(self.x*self.x + self.y*self.y)
+        return EuPoint(coeff * self.x, coeff * self.y)
 
     def sqdistance(self, point):
-        return (self.x - point.x)**2 + (self.y - point.y)**2
+        dx = self.x - point.x
+        dy = self.y - point.y
+        return dx*dx + dy*dy
 
     def distance(self, point):
         return math.sqrt(self.sqdistance(point))
@@ -79,7 +84,9 @@ class EuPoint:
     def angle_to(self, point):
         return math.atan2(point.y - self.y, point.x - self.x)
 
-class EuLine:
+class EuLine(object):
+
+    __slots__ = ('a', 'b', 'c')
 
     def __init__(self, a, b, c):
         """ax + by + c = 0"""
@@ -101,7 +108,9 @@ class EuLine:
     def intersection_circle(self, circle):
         return circle.intersection_line(self)
 
-class EuCircle:
+class EuCircle(object):
+
+    __slots__ = ('xx', 'yy', 'r')
 
     def __init__(self, xx, yy, r):
         """(x-xx)^2 + (y-yy)^2 = r^2"""
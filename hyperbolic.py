@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import math
+import cmath
+import numpy
 
 from euclidean import EuPoint, EuLine, EuCircle, crossratio
-from utils import get_actual_dimension
+from utils import get_actual_dimension, user_to_device_array
 from point_cache import GridApproximationSegmentCache
 import chyperbolic
 
@@ -17,15 +19,255 @@ def my_trunc(x):
 POINT_RADIUS = 3.5
 CIRCLE_LINE_THRESHOLD = 0.1
 SEGMENT_CACHE_THRESHOLD = 0.0001
+CULL_PIXEL_TOLERANCE = 1.0
+MOBIUS_RENORMALIZATION_PERIOD = 16
+GEODESIC_DIAMETER_EPSILON = 1e-12
+
+def klein_to_poincare(x, y):
+    """Poincaré coordinates of the point with Klein coordinates (x, y)."""
+    mult = 1.0 / (1.0 + math.sqrt(max(1.0 - x*x - y*y, 0.0)))
+    return (mult * x, mult * y)
+
+def poincare_to_klein(x, y):
+    mult = 2.0 / (1.0 + x*x + y*y)
+    return (mult * x, mult * y)
+
+def klein_to_poincare_array(xy, optimize=True):
+    """Batch version of Point.get_poincare_coords(): xy is an array
+    of Klein coordinates whose last dimension is 2."""
+    if optimize:
+        res = numpy.array(xy, dtype=numpy.float64, order='C')
+        chyperbolic.c_klein_to_poincare_array(res)
+        return res
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    sqnorm = xy[..., 0]**2 + xy[..., 1]**2
+    mult = 1.0 / (1.0 + numpy.sqrt(numpy.maximum(1.0 - sqnorm, 0.0)))
+    return xy * mult[..., numpy.newaxis]
+
+def poincare_to_klein_array(xy):
+    """Batch version of Point.from_poincare_coords()."""
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    mult = 2.0 / (1.0 + xy[..., 0]**2 + xy[..., 1]**2)
+    return xy * mult[..., numpy.newaxis]
+
+def get_poincare_arc(x1, y1, x2, y2):
+    """Geodesic through two points of the Poincaré disc, in closed
+    form: its circle is orthogonal to the unit circle, so its center c
+    satisfies 2 c.p = |p|^2 + 1 for both points. Return (cx, cy,
+    radius, angle1, angle2), where the segment is the counterclockwise
+    arc from angle1 to angle2 (both in [0, 2pi)); if the geodesic is a
+    diameter everything is zero."""
+    det = 2.0 * (x1 * y2 - y1 * x2)
+    if abs(det) < GEODESIC_DIAMETER_EPSILON:
+        return (0.0, 0.0, 0.0, 0.0, 0.0)
+    k1 = x1**2 + y1**2 + 1.0
+    k2 = x2**2 + y2**2 + 1.0
+    cx = (k1 * y2 - y1 * k2) / det
+    cy = (x1 * k2 - k1 * x2) / det
+    radius = math.sqrt(max(cx**2 + cy**2 - 1.0, 0.0))
+    angle1 = math.atan2(y1 - cy, x1 - cx)
+    angle2 = math.atan2(y2 - cy, x2 - cx)
+    if (angle2 - angle1) % (2*math.pi) > math.pi:
+        angle1, angle2 = angle2, angle1
+    return (cx, cy, radius, angle1 % (2*math.pi), angle2 % (2*math.pi))
+
+def get_poincare_arc_array(segments, optimize=True):
+    """Batch version of get_poincare_arc(): segments is a (N, 2, 2)
+    array of Poincaré coordinates, and a (N, 5) array is returned."""
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape((-1, 4))
+    if optimize:
+        res = numpy.empty((len(segments), 5), dtype=numpy.float64)
+        chyperbolic.c_geodesic_arc_array(numpy.ascontiguousarray(segments), res)
+        return res
+    x1, y1, x2, y2 = segments.T
+    res = numpy.zeros((len(segments), 5), dtype=numpy.float64)
+    det = 2.0 * (x1 * y2 - y1 * x2)
+    valid = numpy.abs(det) >= GEODESIC_DIAMETER_EPSILON
+    det = numpy.where(valid, det, 1.0)
+    k1 = x1**2 + y1**2 + 1.0
+    k2 = x2**2 + y2**2 + 1.0
+    cx = (k1 * y2 - y1 * k2) / det
+    cy = (x1 * k2 - k1 * x2) / det
+    radius = numpy.sqrt(numpy.maximum(cx**2 + cy**2 - 1.0, 0.0))
+    angle1 = numpy.arctan2(y1 - cy, x1 - cx)
+    angle2 = numpy.arctan2(y2 - cy, x2 - cx)
+    swap = (angle2 - angle1) % (2*math.pi) > math.pi
+    angle1, angle2 = numpy.where(swap, angle2, angle1), numpy.where(swap, angle1, angle2)
+    for i, values in enumerate([cx, cy, radius, angle1 % (2*math.pi), angle2 % (2*math.pi)]):
+        res[valid, i] = values[valid]
+    return res
+
+def get_sagitta(radius):
+    """Distance between the midpoint of a whole geodesic whose circle
+    has the given radius and the chord joining its ideal endpoints;
+    zero for diameters. Works on arrays too."""
+    hyp = numpy.sqrt(radius**2 + 1.0)
+    return radius / (hyp * (hyp + radius))
+
+def draw_klein_segment_array(ctx, segments):
+    """Draw a (N, 2, 2) array of segments, in (already mapped) Klein
+    coordinates."""
+    ctx.backend.draw_lines(ctx, segments)
+
+def draw_poincare_segment_array(ctx, segments, arcs=None):
+    """Draw a (N, 2, 2) array of segments, in (already mapped)
+    Poincaré coordinates; arcs can be passed if already computed by
+    get_poincare_arc_array()."""
+    if arcs is None:
+        arcs = get_poincare_arc_array(segments)
+    # If a line is too near center, just treat is a line
+    straight = get_sagitta(arcs[:, 2]) < CIRCLE_LINE_THRESHOLD
+    ctx.backend.draw_lines(ctx, segments[straight])
+    ctx.backend.draw_arcs(ctx, arcs[~straight])
+
+class PilBackend:
+    """Draw on ctx.image_draw, with one PIL call per segment (and
+    arcs approximated to integer degrees)."""
+
+    def __repr__(self):
+        return "PilBackend()"
+
+    def clear(self, ctx, color):
+        ctx.image_draw.rectangle([(0, 0), ctx.image.size], fill=color)
+
+    def draw_lines(self, ctx, segments):
+        """segments is a (N, 2, 2) array, in user coordinates."""
+        device = user_to_device_array(ctx.cairo, segments).astype(int).tolist()
+        for p1, p2 in device:
+            ctx.image_draw.line([tuple(p1), tuple(p2)], fill=(0, 0, 0))
+
+    def draw_arcs(self, ctx, arcs):
+        """arcs is a (N, 5) array, as returned by
+        get_poincare_arc_array()."""
+        corners = numpy.empty((len(arcs), 2, 2), dtype=numpy.float64)
+        corners[:, 0, 0] = arcs[:, 0] - arcs[:, 2]
+        corners[:, 0, 1] = arcs[:, 1] + arcs[:, 2]
+        corners[:, 1, 0] = arcs[:, 0] + arcs[:, 2]
+        corners[:, 1, 1] = arcs[:, 1] - arcs[:, 2]
+        corners = user_to_device_array(ctx.cairo, corners).astype(int).reshape((-1, 4)).tolist()
+        degrees = (-arcs[:, 3:5] * (180.0 / math.pi)).astype(int).tolist()
+        for bbox, (end, start) in zip(corners, degrees):
+            ctx.image_draw.arc(bbox, start, end, fill=(0, 0, 0))
+
+    def draw_circle(self, ctx, x, y, radius, color):
+        p1 = tuple(map(int, ctx.cairo.user_to_device(x - radius, y + radius)))
+        p2 = tuple(map(int, ctx.cairo.user_to_device(x + radius, y - radius)))
+        ctx.image_draw.arc([p1[0], p1[1], p2[0], p2[1]], 0, 360, fill=color)
+
+    def finish(self, ctx):
+        pass
+
+class CairoBackend:
+    """Add all the segments to the current path of ctx.cairo, with
+    exact arcs, and stroke it only once, in finish(). Lines are
+    line_width pixels wide whatever the scale of ctx.cairo.
+
+    Cairo stores each pixel as a native endian ARGB word; with
+    rgba_memory the colors are swapped so that, on little endian
+    machines, the surface memory reads as RGBA bytes (like the frame
+    buffers shared with PIL images in draw.py)."""
+
+    def __init__(self, line_width=1.0, rgba_memory=True):
+        self.line_width = line_width
+        self.rgba_memory = rgba_memory
+
+    def __repr__(self):
+        return "CairoBackend(line_width=%r, rgba_memory=%r)" % (self.line_width, self.rgba_memory)
+
+    def set_color(self, ctx, color):
+        red, green, blue = [c / 255.0 for c in color]
+        if self.rgba_memory:
+            red, blue = blue, red
+        ctx.cairo.set_source_rgb(red, green, blue)
+
+    def clear(self, ctx, color):
+        ctx.cairo.new_path()
+        self.set_color(ctx, color)
+        ctx.cairo.paint()
+
+    def draw_lines(self, ctx, segments):
+        cairo = ctx.cairo
+        for (x1, y1), (x2, y2) in segments.tolist():
+            cairo.move_to(x1, y1)
+            cairo.line_to(x2, y2)
+
+    def draw_arcs(self, ctx, arcs):
+        cairo = ctx.cairo
+        for cx, cy, radius, angle1, angle2 in arcs.tolist():
+            cairo.new_sub_path()
+            cairo.arc(cx, cy, radius, angle1, angle2)
+
+    def stroke(self, ctx, color):
+        # The path is already in device space, so stroking it with the
+        # identity matrix gives a line width in pixels
+        cairo = ctx.cairo
+        cairo.save()
+        cairo.identity_matrix()
+        cairo.set_line_width(self.line_width)
+        self.set_color(ctx, color)
+        cairo.stroke()
+        cairo.restore()
+
+    def draw_circle(self, ctx, x, y, radius, color):
+        # Stroke the segments added so far first, so that they are not
+        # drawn with the color of the circle
+        self.finish(ctx)
+        ctx.cairo.arc(x, y, radius, 0.0, 2*math.pi)
+        self.stroke(ctx, color)
+
+    def finish(self, ctx):
+        self.stroke(ctx, (0, 0, 0))
+
+class CullStats:
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        return "CullStats(drawn=%d, culled_small=%d, culled_outside=%d)" % \
+            (self.drawn, self.culled_small, self.culled_outside)
+
+    def reset(self):
+        self.drawn = 0
+        self.culled_small = 0
+        self.culled_outside = 0
+
+    def get_culled(self):
+        return self.culled_small + self.culled_outside
 
 class HyperbolicContext:
 
-    def __init__(self, cairo, isom, poincare):
+    def __init__(self, cairo, isom, poincare, size=None, backend=None):
         self.cairo = cairo
         self.isom = isom
         self.poincare = poincare
 
-class Point:
+        # Segments are drawn by the backend (by default a PilBackend);
+        # call backend.finish() when the frame is complete
+        self.backend = backend if backend is not None else PilBackend()
+
+        # A (height, width, 4) array sharing the memory of image, for
+        # backends that draw with numpy (see raster.get_pixels())
+        self.pixels = None
+
+        # When size is known, segments shorter than cull_tolerance
+        # pixels or out of the window are not drawn
+        self.size = size
+        self.cull_tolerance = CULL_PIXEL_TOLERANCE
+        self.cull_stats = CullStats()
+
+        # A profiling.FrameProfiler, if stage timings are wanted
+        self.profiler = None
+
+# Points, lines and isometries are immutable values: their slots are
+# set when they are created and never changed afterwards, apart from
+# the caches of derived quantities (like poincare_coords or inverse),
+# which are filled when they are first needed. Hot methods work on
+# coordinates, instead of converting to and from intermediate objects.
+
+class Point(object):
+
+    __slots__ = ('x', 'y', 'poincare_coords', 'metric')
 
     def __init__(self, x, y):
         self.x = x
@@ -56,28 +298,29 @@ class Point:
 
     def get_poincare_coords(self):
         if self.poincare_coords is None:
-            mult = 1.0 / (1.0 + math.sqrt(1.0 - self.to_eupoint().sqnorm()))
-            self.poincare_coords = (mult * self.x, mult * self.y)
+            x, y = self.x, self.y
+            mult = 1.0 / (1.0 + math.sqrt(1.0 - x*x - y*y))
+            self.poincare_coords = (mult * x, mult * y)
 
         return self.poincare_coords
 
     @classmethod
     def from_poincare_coords(cls, x, y):
-        mult = 2.0 / (1.0 + EuPoint(x, y).sqnorm())
+        mult = 2.0 / (1.0 + x*x + y*y)
         p = Point(mult * x, mult * y)
         p.poincare_coords = (x, y)
         return p
 
     def draw_klein(self, ctx, dont_map=False):
         if dont_map:
-            p = self
+            x, y = self.x, self.y
         else:
-            p = ctx.isom.map(self)
-        #ctx.cairo.arc(p.x, p.y, get_actual_dimension(ctx.cairo, POINT_RADIUS), 0, 2*math.pi)
+            x, y = ctx.isom.map_to_klein(self)
+        #ctx.cairo.arc(x, y, get_actual_dimension(ctx.cairo, POINT_RADIUS), 0, 2*math.pi)
         #ctx.cairo.fill()
         actual_radius = get_actual_dimension(ctx.cairo, POINT_RADIUS)
-        p1 = tuple(map(int, ctx.cairo.user_to_device(p.x - actual_radius, p.y + actual_radius)))
-        p2 = tuple(map(int, ctx.cairo.user_to_device(p.x + actual_radius, p.y - actual_radius)))
+        p1 = tuple(map(int, ctx.cairo.user_to_device(x - actual_radius, y + actual_radius)))
+        p2 = tuple(map(int, ctx.cairo.user_to_device(x + actual_radius, y - actual_radius)))
         ctx.image_draw.arc([p1[0], p1[1], p2[0], p2[1]], 0, 360, fill=(0, 255, 0))
 
         # Old code
@@ -87,11 +330,9 @@ class Point:
 
     def draw_poincare(self, ctx, dont_map=False):
         if dont_map:
-            p = self
+            x, y = self.get_poincare_coords()
         else:
-            p = ctx.isom.map(self)
-        #print p.x, p.y
-        x, y = p.get_poincare_coords()
+            x, y = ctx.isom.map_to_poincare(self)
         #print x, y
         # ctx.cairo.arc(x, y, get_actual_dimension(ctx.cairo, POINT_RADIUS), 0, 2*math.pi)
         # ctx.cairo.fill()
@@ -107,17 +348,16 @@ class Point:
             self.draw_klein(ctx, dont_map=dont_map)
 
     def line_to(self, point):
-        point = point.to_point()
-        eu1 = EuPoint(self.x, self.y)
-        eu2 = EuPoint(point.x, point.y)
-        euline = eu1.line_to(eu2)
-        extrema = euline.intersection_circle(EuCircle(0.0, 0.0, 1.0))
-        p1, p2 = map(lambda p: InfPoint.from_xy(p.x, p.y), extrema)
+        x1, y1 = self.x, self.y
+        x2, y2 = point.get_coords()
+        a, b, c = chyperbolic.c_eupoint_line_to(x1, y1, x2, y2)
+        p1, p2 = [InfPoint.from_xy(x, y) for x, y in
+                  chyperbolic.c_eucircle_intersection_line(0.0, 0.0, 1.0, a, b, c)]
 
         # Fix the order; probably it would be better to implement
         # oriented EuLines
-        if p1.to_point().to_eupoint().sqdistance(eu1) > \
-                p1.to_point().to_eupoint().sqdistance(eu2):
+        x, y = p1.get_coords()
+        if (x - x1)**2 + (y - y1)**2 > (x - x2)**2 + (y - y2)**2:
             p1, p2 = p2, p1
 
         return Line(p1, p2)
@@ -152,7 +392,9 @@ class Point:
         factor = 1.0 / (math.sqrt(self.scal(v, v)))
         return (v[0]*factor, v[1]*factor)
 
-class InfPoint:
+class InfPoint(object):
+
+    __slots__ = ('alpha', 'coords')
 
     def __init__(self, alpha):
         self.alpha = alpha
@@ -171,7 +413,7 @@ class InfPoint:
 
     @classmethod
     def from_point(self, point):
-        return InfPoint.from_eupoint(point.to_eupoint())
+        return InfPoint.from_xy(*point.get_coords())
 
     def line_to(self, inf_point):
         return Line(self, inf_point)
@@ -180,7 +422,7 @@ class InfPoint:
         return Segment(self, inf_point)
 
     def normalize(self):
-        self.alpha = self.alpha - 2*math.pi * my_trunc(self.alpha / (2*math.pi))
+        return InfPoint(self.alpha - 2*math.pi * my_trunc(self.alpha / (2*math.pi)))
 
     def get_coords(self):
         if self.coords is None:
@@ -195,13 +437,14 @@ class InfPoint:
         return Point(x, y)
 
     def to_eupoint(self):
-        return self.to_point().to_eupoint()
+        x, y = self.get_coords()
+        return EuPoint(x, y)
 
     def to_eupoint_poincare(self):
         return self.to_eupoint()
 
     def draw_klein(self, ctx):
-        x, y = ctx.isom.map(self.to_point()).get_coords()
+        x, y = ctx.isom.map_to_klein(self)
         ctx.cairo.arc(x, y, get_actual_dimension(ctx.cairo, POINT_RADIUS), 0, 2*math.pi)
         ctx.cairo.fill()
 
@@ -219,7 +462,10 @@ class InfPoint:
 
 SEGMENT_POINCARE_FAR_FIELD_THRESHOLD = 0.1
 
-class Segment:
+class Segment(object):
+
+    __slots__ = ('p1', 'p2')
+
     def __init__(self, p1, p2):
         """Two finite or infinite points (of the same type)."""
         self.p1 = p1
@@ -228,69 +474,48 @@ class Segment:
     def to_line(self):
         return p1.line_to(p2)
 
-    def draw_klein(self, ctx):
-        p1 = ctx.isom.map(self.p1)
-        p2 = ctx.isom.map(self.p2)
-        # x1, y1 = p1.get_coords()
-        # x2, y2 = p2.get_coords()
-        # ctx.cairo.move_to(x1, y1)
-        # ctx.cairo.line_to(x2, y2)
+    def draw_klein(self, ctx, dont_map=False):
+        if dont_map:
+            c1, c2 = self.p1.get_coords(), self.p2.get_coords()
+        else:
+            c1, c2 = ctx.isom.map_to_klein(self.p1), ctx.isom.map_to_klein(self.p2)
+        # ctx.cairo.move_to(*c1)
+        # ctx.cairo.line_to(*c2)
         # ctx.cairo.stroke()
-        p1_pil = tuple(map(int, ctx.cairo.user_to_device(*p1.get_coords())))
-        p2_pil = tuple(map(int, ctx.cairo.user_to_device(*p2.get_coords())))
+        p1_pil = tuple(map(int, ctx.cairo.user_to_device(*c1)))
+        p2_pil = tuple(map(int, ctx.cairo.user_to_device(*c2)))
         ctx.image_draw.line([p1_pil, p2_pil], fill=(0, 0, 0))
 
-    def draw_poincare(self, ctx):
-        p1 = ctx.isom.map(self.p1)
-        p2 = ctx.isom.map(self.p2)
-        line = p1.line_to(p2)
-        ref = line.ref_point()
-        ref_klein = ref.to_eupoint()
-        ref_poincare = ref.to_eupoint_poincare()
-        sagitta = ref.to_eupoint().distance(ref_poincare)
-        p1_pc = p1.to_eupoint_poincare()
-        p2_pc = p2.to_eupoint_poincare()
+    def draw_poincare(self, ctx, dont_map=False):
+        if dont_map:
+            x1, y1 = self.p1.get_poincare_coords()
+            x2, y2 = self.p2.get_poincare_coords()
+        else:
+            x1, y1 = ctx.isom.map_to_poincare(self.p1)
+            x2, y2 = ctx.isom.map_to_poincare(self.p2)
+        cx, cy, radius, angle1, angle2 = get_poincare_arc(x1, y1, x2, y2)
 
         # If line is too near center, just treat is a line
-        if sagitta < CIRCLE_LINE_THRESHOLD:# or min(p1_pc.sqnorm(), p2_pc.sqnorm()) > 1.0 - SEGMENT_POINCARE_FAR_FIELD_THRESHOLD:
-            #ctx.cairo.move_to(*p1_pc.get_coords())
-            #ctx.cairo.line_to(*p2_pc.get_coords())
-            #ctx.cairo.stroke()
-            p1_pil = tuple(map(int, ctx.cairo.user_to_device(*p1_pc.get_coords())))
-            p2_pil = tuple(map(int, ctx.cairo.user_to_device(*p2_pc.get_coords())))
+        if get_sagitta(radius) < CIRCLE_LINE_THRESHOLD:
+            p1_pil = tuple(map(int, ctx.cairo.user_to_device(x1, y1)))
+            p2_pil = tuple(map(int, ctx.cairo.user_to_device(x2, y2)))
             ctx.image_draw.line([p1_pil, p2_pil], fill=(0, 0, 0))
 
-        # Else compute radius and center point and draw it
+        # Else draw the arc of the orthogonal circle
         else:
-            semichord = line.p1.to_eupoint().distance(ref.to_eupoint())
-            radius = (sagitta**2 + semichord**2) / (2 * sagitta)
-            sagitta_versor = ref_klein.subtract(ref_poincare).normalize()
-            center = ref_poincare.add(sagitta_versor.multiply(radius))
-            angle1 = center.angle_to(p1_pc)
-            angle2 = center.angle_to(p2_pc)
-            if (angle2 - angle1) % (2*math.pi) > math.pi:
-                angle1, angle2 = angle2, angle1
-            angle1 = angle1 % (2*math.pi)
-            angle2 = angle2 % (2*math.pi)
-            #print angle1, angle2
-            #ctx.cairo.arc(center.x, center.y, radius, angle1, angle2) 
-            #ctx.cairo.stroke()
-            p1 = tuple(map(int, ctx.cairo.user_to_device(center.x - radius, center.y + radius)))
-            p2 = tuple(map(int, ctx.cairo.user_to_device(center.x + radius, center.y - radius)))
-            #Point(*center.get_coords()).draw_klein(ctx, dont_map=True)
-            #print p1, p2
-            #print angle1, angle2
-            #ctx.image_draw.arc([p1[0], p1[1], p2[0], p2[1]], 0, 360, fill=(0, 128, 0))
+            p1 = tuple(map(int, ctx.cairo.user_to_device(cx - radius, cy + radius)))
+            p2 = tuple(map(int, ctx.cairo.user_to_device(cx + radius, cy - radius)))
             ctx.image_draw.arc([p1[0], p1[1], p2[0], p2[1]], -int(angle2 * 180.0 / math.pi), -int(angle1 * 180.0 / math.pi), fill=(0, 0, 0))
-            #ctx.image_draw.line([p1, p2], fill=(0, 0, 128))
 
-    def draw(self, ctx):
+    def draw(self, ctx, dont_map=False):
         if ctx.poincare:
-            self.draw_poincare(ctx)
+            self.draw_poincare(ctx, dont_map=dont_map)
         else:
-            self.draw_klein(ctx)
+            self.draw_klein(ctx, dont_map=dont_map)
+
+class Line(object):
 
-class Line:
+    __slots__ = ('p1', 'p2')
 
     def __init__(self, p1, p2):
         """Two infinite points"""
@@ -303,7 +528,7 @@ class Line:
     def to_euline(self):
         x1, y1 = self.p1.get_coords()
         x2, y2 = self.p2.get_coords()
-        return EuPoint(x1, y1).line_to(EuPoint(x2, y2))
+        return EuLine(*chyperbolic.c_eupoint_line_to(x1, y1, x2, y2))
 
     def to_segment(self):
         return self.p1.segment_to(self.p2)
@@ -323,10 +548,10 @@ class Line:
 
     def point_at_coordinate(self, d):
         k = 1.0 + math.exp(2 * d)
-        p1 = self.p1.to_point()
-        p2 = self.p2.to_point()
-        x = p2.x + (p1.x - p2.x) / k
-        y = p2.y + (p1.y - p2.y) / k
+        x1, y1 = self.p1.get_coords()
+        x2, y2 = self.p2.get_coords()
+        x = x2 + (x1 - x2) / k
+        y = y2 + (y1 - y2) / k
         return Point(x, y)
 
     def ref_point(self):
@@ -341,9 +566,9 @@ class Line:
         return self.ref_point().distance(point, line=self)
 
     def get_angle(self):
-        p1 = self.p1.to_point()
-        p2 = self.p2.to_point()
-        return math.atan2(p2.y - p1.y, p2.x - p1.x)
+        x1, y1 = self.p1.get_coords()
+        x2, y2 = self.p2.get_coords()
+        return math.atan2(y2 - y1, x2 - x1)
 
     def to_pv(self, point=None):
         if point is None:
@@ -357,7 +582,9 @@ class Line:
             intersection = self.intersection(line)
         return self.to_pv(point=intersection).angle_with(line.to_pv(point=intersection))
 
-class Isometry:
+class Isometry(object):
+
+    __slots__ = ('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'inverse')
 
     def __init__(self, A=1.0, B=0.0, C=0.0, D=0.0, E=1.0, F=0.0, G=0.0, H=0.0, I=1.0):
         self.A, self.B, self.C, self.D, self.E, self.F, self.G, self.H, self.I = \
@@ -370,21 +597,61 @@ class Isometry:
         return "Isometry([%f, %f, %f; %f, %f, %f; %f, %f, %f])" % (self.A, self.B, self.C, self.D, self.E, self.F, self.G, self.H, self.I)
 
     def map(self, p):
-        infpoint = False
+        x, y = p.get_coords()
+        coeff = 1.0 / (self.G * x + self.H * y + self.I)
+        new_x = coeff * (self.A * x + self.B * y + self.C)
+        new_y = coeff * (self.D * x + self.E * y + self.F)
         if isinstance(p, InfPoint):
-            infpoint = True
-        p = p.to_point()
-        coeff = 1.0 / (self.G * p.x + self.H * p.y + self.I)
-        new_x = coeff * (self.A * p.x + self.B * p.y + self.C)
-        new_y = coeff * (self.D * p.x + self.E * p.y + self.F)
-        if infpoint:
             return InfPoint.from_xy(new_x, new_y)
         else:
             return Point(new_x, new_y)
 
+    def map_to_klein(self, p):
+        """Klein coordinates of map(p), without creating it (unless p is
+        an InfPoint, which has to be brought back on the circle)."""
+        if isinstance(p, InfPoint):
+            return self.map(p).get_coords()
+        x, y = p.get_coords()
+        coeff = 1.0 / (self.G * x + self.H * y + self.I)
+        return (coeff * (self.A * x + self.B * y + self.C),
+                coeff * (self.D * x + self.E * y + self.F))
+
+    def map_to_poincare(self, p):
+        """Poincaré coordinates of map(p), like map_to_klein()."""
+        if isinstance(p, InfPoint):
+            return self.map(p).get_coords()
+        return klein_to_poincare(*self.map_to_klein(p))
+
+    def map_array(self, xy, optimize=True):
+        """Map an array of Klein coordinates (whose last dimension is
+        2) in a single pass; a new array of the same shape is
+        returned."""
+        if optimize:
+            res = numpy.array(xy, dtype=numpy.float64, order='C')
+            chyperbolic.c_isometry_map_array(self.A, self.B, self.C, self.D, self.E,
+                                             self.F, self.G, self.H, self.I, res)
+            return res
+        xy = numpy.asarray(xy, dtype=numpy.float64)
+        x = xy[..., 0]
+        y = xy[..., 1]
+        res = numpy.empty(xy.shape, dtype=numpy.float64)
+        coeff = 1.0 / (self.G * x + self.H * y + self.I)
+        res[..., 0] = coeff * (self.A * x + self.B * y + self.C)
+        res[..., 1] = coeff * (self.D * x + self.E * y + self.F)
+        return res
+
     def map_pv(self, pv):
         pass
 
+    def get_matrix(self):
+        return numpy.array([[self.A, self.B, self.C],
+                            [self.D, self.E, self.F],
+                            [self.G, self.H, self.I]])
+
+    @classmethod
+    def from_matrix(cls, m):
+        return Isometry(*[float(x) for x in numpy.asarray(m).flatten()])
+
     def get_inverse(self):
         if self.inverse is None:
             det = self.A * self.E * self.I + self.B * self.F * self.G + self.D * self.H * self.C  \
@@ -405,6 +672,8 @@ class Isometry:
         return self.inverse
 
     def compose(self, a):
+        if isinstance(a, MobiusIsometry):
+            a = a.to_isometry()
         composite = Isometry(
             self.A * a.A + self.B * a.D + self.C * a.G,
             self.A * a.B + self.B * a.E + self.C * a.H,
@@ -447,19 +716,160 @@ class Isometry:
                              0.0, 0.0, 1.0)
         return pv2.get_isometry().compose(inversion).compose(pv1.get_isometry().get_inverse())
 
-class PointedVector:
+class MobiusIsometry:
+    """A direct isometry stored as an element of SU(1, 1), i.e. the
+    Möbius transformation z -> (a z + b) / (conj(b) z + conj(a)) of
+    the Poincaré disc, with |a|^2 - |b|^2 = 1. It has the same
+    interface as Isometry, but compositions and inverses are much
+    cheaper; any (a, b) with |a| > |b| can be brought back onto the
+    group just by rescaling, which compose() does every
+    MOBIUS_RENORMALIZATION_PERIOD steps."""
+
+    def __init__(self, a=1.0, b=0.0):
+        self.a = complex(a)
+        self.b = complex(b)
+
+        self.steps = 0
+        self.inverse = None
+        self.isometry = None
+
+    def __repr__(self):
+        return "MobiusIsometry(a=%s, b=%s)" % (self.a, self.b)
+
+    def renormalize(self):
+        norm = math.sqrt(abs(self.a)**2 - abs(self.b)**2)
+        self.a /= norm
+        self.b /= norm
+        self.steps = 0
+        self.inverse = None
+        self.isometry = None
+
+    def map_poincare(self, x, y):
+        z = complex(x, y)
+        w = (self.a * z + self.b) / (self.b.conjugate() * z + self.a.conjugate())
+        return (w.real, w.imag)
+
+    def map_poincare_array(self, xy):
+        xy = numpy.asarray(xy, dtype=numpy.float64)
+        z = xy[..., 0] + 1j * xy[..., 1]
+        w = (self.a * z + self.b) / (self.b.conjugate() * z + self.a.conjugate())
+        res = numpy.empty(xy.shape, dtype=numpy.float64)
+        res[..., 0] = w.real
+        res[..., 1] = w.imag
+        return res
+
+    def map(self, p):
+        if isinstance(p, InfPoint):
+            x, y = self.map_poincare(*p.get_coords())
+            return InfPoint.from_xy(x, y)
+        else:
+            return Point.from_poincare_coords(*self.map_poincare(*p.get_poincare_coords()))
+
+    def map_to_klein(self, p):
+        """Same as Isometry.map_to_klein()."""
+        if isinstance(p, InfPoint):
+            return self.map(p).get_coords()
+        return poincare_to_klein(*self.map_to_poincare(p))
+
+    def map_to_poincare(self, p):
+        """Same as Isometry.map_to_poincare()."""
+        if isinstance(p, InfPoint):
+            return self.map(p).get_coords()
+        return self.map_poincare(*p.get_poincare_coords())
+
+    def map_array(self, xy, optimize=True):
+        """Klein coordinates in and out, like Isometry.map_array()."""
+        return self.to_isometry().map_array(xy, optimize=optimize)
+
+    def get_matrix(self):
+        return self.to_isometry().get_matrix()
+
+    def get_inverse(self):
+        if self.inverse is None:
+            self.inverse = MobiusIsometry(self.a.conjugate(), -self.b)
+            self.inverse.steps = self.steps
+            self.inverse.inverse = self
+        return self.inverse
+
+    def compose(self, m):
+        if not isinstance(m, MobiusIsometry):
+            m = MobiusIsometry.from_isometry(m)
+        composite = MobiusIsometry(self.a * m.a + self.b * m.b.conjugate(),
+                                   self.a * m.b + self.b * m.a.conjugate())
+        composite.steps = max(self.steps, m.steps) + 1
+        if composite.steps >= MOBIUS_RENORMALIZATION_PERIOD:
+            composite.renormalize()
+        return composite
+
+    def to_isometry(self):
+        """The projective matrix acting on Klein coordinates."""
+        if self.isometry is None:
+            a, b = self.a, self.b
+            a2, b2, ab, abc = a * a, b * b, a * b, a * b.conjugate()
+            self.isometry = Isometry(
+                a2.real + b2.real, -a2.imag + b2.imag, 2.0 * ab.real,
+                a2.imag + b2.imag, a2.real - b2.real, 2.0 * ab.imag,
+                2.0 * abc.real, -2.0 * abc.imag, abs(a)**2 + abs(b)**2)
+        return self.isometry
+
+    @classmethod
+    def from_isometry(cls, isom):
+        """Only direct isometries can be converted."""
+        scale = math.sqrt(isom.I**2 - isom.C**2 - isom.F**2)
+        if isom.I < 0.0:
+            scale = -scale
+        A, B, C, D, E, F, G, H, I = [x / scale for x in
+                                     [isom.A, isom.B, isom.C, isom.D, isom.E,
+                                      isom.F, isom.G, isom.H, isom.I]]
+        if A * E - B * D < 0.0:
+            raise Exception("Cannot convert an inverse isometry to SU(1, 1)")
+        a = cmath.sqrt(complex(0.5 * (A + E), 0.5 * (D - B)))
+        b = complex(0.5 * C, 0.5 * F) / a
+        m = MobiusIsometry(a, b)
+        m.renormalize()
+        return m
+
+    @classmethod
+    def rotation(cls, x, y, alpha):
+        """Same parameters as Isometry.rotation()."""
+        center = MobiusIsometry.point_translation(*Point(x, y).get_poincare_coords())
+        rot = MobiusIsometry(cmath.exp(0.5j * alpha), 0.0)
+        return center.compose(rot).compose(center.get_inverse())
+
+    @classmethod
+    def translation(cls, x1, y1, x2, y2):
+        """Same parameters as Isometry.translation()."""
+        start = MobiusIsometry.point_translation(*Point(x1, y1).get_poincare_coords())
+        x, y = start.get_inverse().map_poincare(*Point(x2, y2).get_poincare_coords())
+        trans = MobiusIsometry.point_translation(x, y)
+        return start.compose(trans).compose(start.get_inverse())
+
+    @classmethod
+    def point_translation(cls, x, y):
+        """The translation that brings the origin to the point with
+        Poincaré coordinates (x, y) along their diameter."""
+        norm = math.sqrt(1.0 - x**2 - y**2)
+        return MobiusIsometry(1.0 / norm, complex(x, y) / norm)
+
+class PointedVector(object):
+
+    __slots__ = ('x', 'y', 'alpha', 'point', 'base', 'isometry')
 
     def __init__(self, x, y, alpha):
         self.x = x
         self.y = y
         self.alpha = alpha
 
+        self.point = None
         self.base = None
         self.isometry = None
 
     def __repr__(self):
         return "PointedVector(x=%f, y=%f, alpha=%f)" % (self.x, self.y, self.alpha)
 
+    def get_coords(self):
+        return (self.x, self.y)
+
     def get_metric(self):
         return self.to_point().get_metric()
 
@@ -495,9 +905,9 @@ class PointedVector:
 
             l1p2 = l1.p2.to_eupoint()
             l2p2 = l2.p2.to_eupoint()
+            eupoint = EuPoint(self.x, self.y)
 
             def calc_coeffs(l):
-                eupoint = self.to_point().to_eupoint()
                 k = l.p1.to_eupoint().distance(eupoint)
                 h = l.p2.to_eupoint().distance(eupoint)
                 coeff = 2.0 / (h + k)
@@ -543,14 +953,17 @@ class PointedVector:
         return PointedVector(self.x, self.y, math.pi + self.alpha)
 
     def get_there(self):
-        here = self.to_point()
-        dist = 0.5 * (1.0 - here.to_eupoint().norm())
-        there = Point(here.x + dist * math.cos(self.alpha),
-                      here.y + dist * math.sin(self.alpha))
+        dist = 0.5 * (1.0 - math.sqrt(self.x*self.x + self.y*self.y))
+        there = Point(self.x + dist * math.cos(self.alpha),
+                      self.y + dist * math.sin(self.alpha))
         return there
 
     def to_point(self):
-        return Point(self.x, self.y)
+        # Points are immutable, so the same one (with its metric,
+        # once computed) can be shared
+        if self.point is None:
+            self.point = Point(self.x, self.y)
+        return self.point
 
     def to_line(self):
         here = self.to_point()
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy
+
+import coxeter
+import polygons
+import profiling
+
+class TileInstances:
+    """A regular tessellation stored as one prototype polygon and one
+    projective matrix per tile.
+
+    prototype is a (p, 2) array with the Klein coordinates of the
+    prototype's vertices, matrices is a (T, 3, 3) array whose t-th
+    element maps the prototype to the t-th tile. Since each side is
+    shared by two tiles, edge_mask is a (T, p) boolean array that
+    selects which sides have to be drawn: side k of a tile joins its
+    vertices k and k+1."""
+
+    def __init__(self, prototype, matrices, edge_mask):
+        self.prototype = prototype
+        self.matrices = matrices
+        self.edge_mask = edge_mask
+
+    def __repr__(self):
+        return "TileInstances(tiles=%d, sides=%d)" % (self.get_tile_num(), len(self.prototype))
+
+    def get_tile_num(self):
+        return len(self.matrices)
+
+    def get_nbytes(self):
+        return self.prototype.nbytes + self.matrices.nbytes + self.edge_mask.nbytes
+
+    def map_vertices(self, isom=None):
+        """Return the (T, p, 2) array of the vertices of all the
+        tiles, moved by isom if it is given."""
+        matrices = self.matrices
+        if isom is not None:
+            matrices = numpy.dot(isom.get_matrix(), matrices).transpose((1, 0, 2))
+        homogeneous = numpy.empty((len(self.prototype), 3), dtype=numpy.float64)
+        homogeneous[:, :2] = self.prototype
+        homogeneous[:, 2] = 1.0
+        mapped = numpy.dot(matrices, homogeneous.T).transpose((0, 2, 1))
+        return mapped[..., :2] / mapped[..., 2:]
+
+    def get_segment_array(self, isom=None):
+        """The (N, 2, 2) array of the sides to draw, as returned by
+        polygons.build_segment_array()."""
+        vertices = self.map_vertices(isom)
+        segments = numpy.empty(vertices.shape[:2] + (2, 2), dtype=numpy.float64)
+        segments[:, :, 0] = vertices
+        segments[:, :, 1] = numpy.roll(vertices, -1, axis=1)
+        return segments[self.edge_mask]
+
+def build_tile_instances(side_num, valence_num, pv=None, max_length=None,
+                         max_tiles=None, max_radius=None):
+    prototype = coxeter.get_fundamental_polygon(side_num, valence_num)
+    tiles = list(coxeter.iter_coxeter_tessellation(side_num, valence_num, pv=pv,
+                                                   max_length=max_length,
+                                                   max_tiles=max_tiles,
+                                                   max_radius=max_radius))
+    # Each side is drawn by just one of the two tiles sharing it: the
+    # one generated first (with the shorter word), unless the other
+    # one was not generated at all. Neighbors are found from the words,
+    # so no geometric comparison is needed
+    tits = coxeter.get_tits_generators(side_num, valence_num)
+    sides = coxeter.get_side_elements(side_num, tits)
+    # The parent of each tile (its word without the first letter) comes
+    # before it, so the Tits matrices can be built one letter at a time
+    words = set(word for word, isom in tiles)
+    elements = {'': (coxeter.IDENTITY, coxeter.IDENTITY)}
+    edge_mask = []
+    for word, isom in tiles:
+        if word not in elements:
+            s = tits[coxeter.GENERATORS.index(word[0])]
+            sigma, sigma_inv = elements[word[1:]]
+            elements[word] = (coxeter.mat_mult(s, sigma), coxeter.mat_mult(sigma_inv, s))
+        mask = []
+        for side in sides:
+            neighbor = coxeter.get_neighbor_word(elements[word], side, tits)
+            mask.append(neighbor not in words or (len(word), word) < (len(neighbor), neighbor))
+        edge_mask.append(mask)
+
+    return TileInstances(numpy.array([p.get_coords() for p in prototype]),
+                         numpy.array([isom.get_matrix() for word, isom in tiles]).reshape((-1, 3, 3)),
+                         numpy.array(edge_mask, dtype=bool).reshape((-1, side_num)))
+
+def draw_instances(ctx, instances):
+    """Compose the view isometry with each tile's matrix and draw the
+    mapped prototype."""
+    with profiling.stage(ctx.profiler, 'mapping'):
+        segments = instances.get_segment_array(ctx.isom)
+    polygons.draw_mapped_segments(ctx, segments)
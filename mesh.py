@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import numpy
+
+from point_cache import GridApproximationPointIndex
+import polygons
+import profiling
+
+class Mesh:
+    """A tessellation stored as an indexed mesh: each vertex appears
+    once in the vertices buffer, and edges and faces refer to it by
+    index.
+
+    vertices is a (V, 2) array of Klein coordinates, edges is a (E,
+    2) int32 array of vertex indices, while faces are stored
+    contiguously in the faces int32 array: the vertices of face i are
+    faces[face_offsets[i]:face_offsets[i+1]]."""
+
+    def __init__(self, vertices, edges, faces, face_offsets):
+        self.vertices = vertices
+        self.edges = edges
+        self.faces = faces
+        self.face_offsets = face_offsets
+
+    def __repr__(self):
+        return "Mesh(vertices=%d, edges=%d, faces=%d)" % (self.get_vertex_num(),
+                                                          self.get_edge_num(),
+                                                          self.get_face_num())
+
+    def get_vertex_num(self):
+        return len(self.vertices)
+
+    def get_edge_num(self):
+        return len(self.edges)
+
+    def get_face_num(self):
+        return len(self.face_offsets) - 1
+
+    def get_face(self, i):
+        return self.faces[self.face_offsets[i]:self.face_offsets[i+1]]
+
+    def get_nbytes(self):
+        return self.vertices.nbytes + self.edges.nbytes + \
+            self.faces.nbytes + self.face_offsets.nbytes
+
+    def get_segment_array(self):
+        """The (E, 2, 2) array of the edges' endpoints, as returned by
+        polygons.build_segment_array()."""
+        return self.vertices[self.edges].astype(numpy.float64)
+
+def build_mesh(polygons_list, dtype=numpy.float64, epsilon=polygons.CACHE_EPSILON):
+    """Build a Mesh from a list of polygons, as returned by
+    polygons.build_regular_tessellation(); vertices nearer than
+    epsilon are merged."""
+    index = GridApproximationPointIndex(epsilon)
+    vertices = []
+    edges = []
+    edge_set = set()
+    faces = []
+    face_offsets = [0]
+
+    for points in polygons_list:
+        face = []
+        for point in points:
+            point = point.to_point()
+            i = index.query(point)
+            if i is None:
+                i = len(vertices)
+                index.store(point, i)
+                vertices.append((point.x, point.y))
+            face.append(i)
+
+        for j in xrange(len(face)):
+            i1, i2 = face[j], face[(j+1) % len(face)]
+            key = (min(i1, i2), max(i1, i2))
+            if key not in edge_set:
+                edge_set.add(key)
+                edges.append((i1, i2))
+
+        faces.extend(face)
+        face_offsets.append(len(faces))
+
+    return Mesh(numpy.array(vertices, dtype=dtype).reshape((-1, 2)),
+                numpy.array(edges, dtype=numpy.int32).reshape((-1, 2)),
+                numpy.array(faces, dtype=numpy.int32),
+                numpy.array(face_offsets, dtype=numpy.int32))
+
+def build_regular_mesh(side_num, valence_num, pv, dtype=numpy.float64):
+    return build_mesh(polygons.build_regular_tessellation(side_num, valence_num, pv), dtype=dtype)
+
+def draw_mesh(ctx, mesh, index=None):
+    """Map each vertex of the mesh once, then draw its edges. If an
+    spatial.EdgeIndex built on mesh.get_segment_array() is given, only
+    the edges that it reports as visible are drawn."""
+    with profiling.stage(ctx.profiler, 'mapping'):
+        edges = mesh.edges
+        if index is not None and ctx.size is not None:
+            edges = edges[index.query_visible(ctx)]
+        mapped = ctx.isom.map_array(mesh.vertices)[edges]
+    polygons.draw_mapped_segments(ctx, mapped)
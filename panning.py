@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Unbounded panning over a regular tessellation.
+
+A regular tessellation is invariant under the isometries that map its
+central tile to any other tile, so instead of growing the patch in the
+direction of the view, the view isometry is re-rooted: when the view
+center enters another tile, the symmetry bringing the central tile
+there is folded into the view isometry. The picture does not change,
+while the view center is brought back into the central tile, so the
+same fixed patch (built once, with constant memory) is always the one
+around the view and the view matrix never grows."""
+
+import numpy
+
+from hyperbolic import Point, Isometry
+import coxeter
+import mesh
+import polygons
+import spatial
+
+# Word lengths at which iter_progressive_tessellations() cuts the
+# partial tessellations
+PROGRESSIVE_LENGTHS = (4, 8, 12)
+
+class RootedTessellation:
+
+    def __init__(self, side_num, valence_num, max_length=None, max_tiles=None,
+                 max_radius=None, store=None):
+        """If store (a tessellation_store.TessellationStore) is given,
+        the arrays are loaded from it if possible, instead of being
+        built."""
+        self.side_num = side_num
+        self.valence_num = valence_num
+        self.max_length = max_length
+        self.max_tiles = max_tiles
+        self.max_radius = max_radius
+
+        if store is not None:
+            arrays = store.get(self.get_store_key(), self.build_arrays)
+        else:
+            arrays = self.build_arrays()
+
+        self.symmetries = arrays['symmetries']
+        self.centers = arrays['centers']
+        self.mesh = mesh.Mesh(arrays['vertices'], arrays['edges'], arrays['faces'],
+                              arrays['face_offsets'])
+        self.index = spatial.EdgeIndex(self.mesh.get_segment_array(), arrays=arrays)
+        self.rebase_count = 0
+
+    def get_store_key(self):
+        return {'kind': 'RootedTessellation',
+                'p': self.side_num,
+                'q': self.valence_num,
+                'root': None,
+                'max_length': self.max_length,
+                'max_tiles': self.max_tiles,
+                'max_radius': self.max_radius,
+                'epsilon': polygons.CACHE_EPSILON,
+                'leaf_size': spatial.LEAF_SIZE}
+
+    def build_arrays(self):
+        """Enumerate the tiles and return the dictionary of the arrays
+        everything else is made of: the symmetries as (T, 3, 3)
+        matrices, the tiles' centers on the hyperboloid, the buffers
+        of the mesh and the tree of its index."""
+        side_num = self.side_num
+        valence_num = self.valence_num
+        reflection = coxeter.get_reflections(side_num, valence_num)[0]
+
+        vertices = coxeter.get_fundamental_polygon(side_num, valence_num)
+        tiles = []
+        symmetries = []
+        for word, isom in coxeter.iter_coxeter_tessellation(side_num, valence_num,
+                                                            max_length=self.max_length,
+                                                            max_tiles=self.max_tiles,
+                                                            max_radius=self.max_radius):
+            tiles.append(coxeter.get_tile_points(side_num, valence_num, word, isom,
+                                                 vertices=vertices))
+            # Use only direct isometries, so that folding them into the
+            # view does not change its orientation; the reflection a
+            # fixes the central tile
+            if len(word) % 2 == 1:
+                isom = isom.compose(reflection)
+            symmetries.append(isom)
+
+        tessellation_mesh = mesh.build_mesh(tiles)
+        index = spatial.EdgeIndex(tessellation_mesh.get_segment_array())
+        arrays = index.get_arrays()
+        arrays.update({
+            'symmetries': numpy.array([s.get_matrix() for s in symmetries]).reshape((-1, 3, 3)),
+            'centers': spatial.klein_to_hyperboloid_array(
+                [s.map(Point(0.0, 0.0)).get_coords() for s in symmetries]).reshape((-1, 3)),
+            'vertices': tessellation_mesh.vertices,
+            'edges': tessellation_mesh.edges,
+            'faces': tessellation_mesh.faces,
+            'face_offsets': tessellation_mesh.face_offsets,
+        })
+        return arrays
+
+    def __repr__(self):
+        return "RootedTessellation({%d, %d}, %r)" % (self.side_num, self.valence_num, self.mesh)
+
+    def get_tile_num(self):
+        return len(self.symmetries)
+
+    def get_view_tile(self, isom):
+        """The index of the tile that contains the view center, i.e.
+        the one whose center is the nearest to it."""
+        center = spatial.klein_to_hyperboloid_array(isom.get_inverse().map(Point(0.0, 0.0)).get_coords())
+        return int(numpy.argmax(spatial.minkowski(center, self.centers)))
+
+    def rebase(self, isom):
+        """Return the (isometry, symmetry) couple, where isometry is
+        isom with symmetry folded into it. symmetry is None if isom
+        already shows the central tile."""
+        tile = self.get_view_tile(isom)
+        if tile == 0:
+            return isom, None
+        self.rebase_count += 1
+        symmetry = Isometry.from_matrix(self.symmetries[tile])
+        return isom.compose(symmetry), symmetry
+
+    def draw(self, ctx):
+        mesh.draw_mesh(ctx, self.mesh, index=self.index)
+
+def iter_progressive_tessellations(side_num, valence_num, lengths=PROGRESSIVE_LENGTHS,
+                                   store=None, max_length=None, **kwargs):
+    """Yield bigger and bigger RootedTessellations: the ones cut at each
+    of lengths that is shorter than max_length, and then the whole one
+    (the only one that goes through store). They all share the same
+    central tile, so a view of one of them is a view of the others
+    too; the first ones take a few milliseconds to build."""
+    for length in lengths:
+        if max_length is None or length < max_length:
+            yield RootedTessellation(side_num, valence_num, max_length=length, **kwargs)
+    yield RootedTessellation(side_num, valence_num, max_length=max_length, store=store, **kwargs)
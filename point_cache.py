@@ -40,6 +40,30 @@ class GridApproximationPointCache:
                     return True
         return False
 
+class GridApproximationPointIndex:
+    """Like GridApproximationPointCache, but remembers an index for
+    each stored point."""
+
+    def __init__(self, epsilon):
+        self.epsilon = epsilon
+        self.points = {}
+
+    def approximate(self, point):
+        x = int(math.floor(point.x / self.epsilon))
+        y = int(math.floor(point.y / self.epsilon))
+        return (x, y)
+
+    def store(self, point, index):
+        self.points[self.approximate(point)] = index
+
+    def query(self, point):
+        x, y = self.approximate(point)
+        for x1 in [x, x-1, x+1]:
+            for y1 in [y, y-1, y+1]:
+                if (x1, y1) in self.points:
+                    return self.points[(x1, y1)]
+        return None
+
 class GridApproximationSegmentCache:
 
     def __init__(self, epsilon):
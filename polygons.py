@@ -3,63 +3,107 @@
 
 import sys
 import math
-from scipy import optimize
+import collections
+import numpy
 
-from hyperbolic import Point, PointedVector, Line
+from hyperbolic import Point, PointedVector, Line, klein_to_poincare_array, \
+    draw_klein_segment_array, draw_poincare_segment_array
 from point_cache import GridApproximationPointCache, GridApproximationSegmentCache
+from utils import user_to_device_array
+import profiling
 
-MIN_SEARCH = 0.00000001
-MAX_SEARCH = 10.0
+# Smaller polygons are taken to be Euclidean: near 1, acosh() is only
+# accurate to about the square root of the machine epsilon
+MIN_RADIUS = 1e-6
+
+RegularPolygon = collections.namedtuple('RegularPolygon', ['circumradius', 'inradius', 'side', 'angle'])
+
+def get_regular_polygon(num, radius=None, side=None, angle=None):
+    """Compute the geometry of the regular polygon with num sides and
+    the given circumradius, side or interior angle (exactly one of
+    them must be given), in closed form.
+
+    Center, vertex and side midpoint form a right triangle, with angle
+    pi/num at the center and half the interior angle at the vertex, so
+    that cosh(circumradius) = cot(pi/num) cot(angle/2), sinh(side/2) =
+    sinh(circumradius) sin(pi/num) and cosh(circumradius) =
+    cosh(inradius) cosh(side/2). Raise ValueError if there is no such
+    polygon."""
+    if len([x for x in (radius, side, angle) if x is not None]) != 1:
+        raise ValueError("Exactly one of radius, side and angle must be given")
+    half_central = math.pi / float(num)
+    try:
+        if radius is not None:
+            side = 2.0 * math.asinh(math.sinh(radius) * math.sin(half_central))
+            angle = 2.0 * math.atan2(1.0, math.cosh(radius) * math.tan(half_central))
+        elif side is not None:
+            radius = math.asinh(math.sinh(0.5 * side) / math.sin(half_central))
+            angle = 2.0 * math.asin(math.cos(half_central) / math.cosh(0.5 * side))
+        else:
+            radius = math.acosh(1.0 / (math.tan(half_central) * math.tan(0.5 * angle)))
+            side = 2.0 * math.asinh(math.sinh(radius) * math.sin(half_central))
+        inradius = math.acosh(math.cosh(radius) / math.cosh(0.5 * side))
+        valid = num >= 3 and radius > MIN_RADIUS and 0.0 < angle < math.pi
+    except (ValueError, ZeroDivisionError):
+        valid = False
+    if not valid:
+        raise ValueError("There is no regular hyperbolic polygon with %d sides and "
+                         "radius %r, side %r, angle %r" % (num, radius, side, angle))
+    return RegularPolygon(radius, inradius, side, angle)
+
+def solve_regular_polygon(num, radius=None, side=None, angle=None):
+    """Vectorized get_regular_polygon(), for parameter sweeps: num and
+    the given argument can be numpy arrays, the fields of the returned
+    RegularPolygon are arrays with their broadcast shape, and are nan
+    where there is no such polygon."""
+    if len([x for x in (radius, side, angle) if x is not None]) != 1:
+        raise ValueError("Exactly one of radius, side and angle must be given")
+    num = numpy.asarray(num, dtype=numpy.float64)
+    half_central = math.pi / num
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if radius is not None:
+            radius = numpy.asarray(radius, dtype=numpy.float64)
+            side = 2.0 * numpy.arcsinh(numpy.sinh(radius) * numpy.sin(half_central))
+            angle = 2.0 * numpy.arctan2(1.0, numpy.cosh(radius) * numpy.tan(half_central))
+        elif side is not None:
+            side = numpy.asarray(side, dtype=numpy.float64)
+            radius = numpy.arcsinh(numpy.sinh(0.5 * side) / numpy.sin(half_central))
+            angle = 2.0 * numpy.arcsin(numpy.cos(half_central) / numpy.cosh(0.5 * side))
+        else:
+            angle = numpy.asarray(angle, dtype=numpy.float64)
+            radius = numpy.arccosh(1.0 / (numpy.tan(half_central) * numpy.tan(0.5 * angle)))
+            side = 2.0 * numpy.arcsinh(numpy.sinh(radius) * numpy.sin(half_central))
+        inradius = numpy.arccosh(numpy.cosh(radius) / numpy.cosh(0.5 * side))
+        valid = (num >= 3) & (radius > MIN_RADIUS) & (angle > 0.0) & (angle < math.pi)
+    return RegularPolygon(*[numpy.where(valid, x, numpy.nan)
+                            for x in numpy.broadcast_arrays(radius, inradius, side, angle)])
+
+def get_tessellation_polygon(side_num, valence_num):
+    """The tile of the {side_num, valence_num} tessellation."""
+    return get_regular_polygon(side_num, angle=2.0 * math.pi / float(valence_num))
 
 def get_angle_from_radius(num, radius):
-    origin = PointedVector(0.0, 0.0, 0.0)
-    p1 = origin.advance(radius)
-    p2 = origin.turn(2 * math.pi / float(num)).advance(radius)
-    ray_line = origin.to_line().reverse()
-    side_line = p1.to_point().line_to(p2.to_point())
-    angle = ray_line.angle_with(side_line, intersection=p1)
-    return 2.0 * angle
+    return get_regular_polygon(num, radius=radius).angle
 
 def get_side_from_radius(num, radius):
-    origin = PointedVector(0.0, 0.0, 0.0)
-    p1 = origin.advance(radius)
-    p2 = origin.turn(2 * math.pi / float(num)).advance(radius)
-    side = p1.to_point().distance(p2.to_point())
-    return side
-
-RADIUS_FROM_SIDE_CACHE = {}
-RADIUS_FROM_ANGLE_CACHE = {}
+    return get_regular_polygon(num, radius=radius).side
 
 def get_radius_from_side(num, side):
-    if (num, side) not in RADIUS_FROM_SIDE_CACHE:
-        func = lambda x: get_side_from_radius(num, x) - side
-        radius, root_results = optimize.brentq(func, MIN_SEARCH, MAX_SEARCH, full_output=True)
-        if root_results.converged:
-            RADIUS_FROM_SIDE_CACHE[(num, side)] = radius
-        else:
-            raise Exception("Could not compute radius")
-    return RADIUS_FROM_SIDE_CACHE[(num, side)]
+    return get_regular_polygon(num, side=side).circumradius
 
 def get_radius_from_angle(num, angle):
-    if (num, angle) not in RADIUS_FROM_ANGLE_CACHE:
-        func = lambda x: get_angle_from_radius(num, x) - angle
-        radius, root_results = optimize.brentq(func, MIN_SEARCH, MAX_SEARCH, full_output=True)
-        if root_results.converged:
-            RADIUS_FROM_ANGLE_CACHE[(num, angle)] = radius
-        else:
-            raise Exception("Could not compute radius")
-    return RADIUS_FROM_ANGLE_CACHE[(num, angle)]
+    return get_regular_polygon(num, angle=angle).circumradius
 
 def flush_inversion_caches():
-    RADIUS_FROM_SIDE_CACHE = {}
-    RADIUS_FROM_ANGLE_CACHE = {}
+    """Nothing to do: radii are computed in closed form, without
+    caches. Kept for compatibility."""
+    pass
 
 def build_polygon_with_center(num, center, pv):
     return [pv.turn(2 * math.pi * float(k) / float(num)).advance(radius).to_point() for k in xrange(num)]
 
 def build_polygon_with_side(num, side, pv):
-    radius = get_radius_from_side(num, side)
-    angle = get_angle_from_radius(num, radius)
+    angle = get_regular_polygon(num, side=side).angle
     points = []
     for i in xrange(num):
         pv = pv.advance(side)
@@ -68,8 +112,7 @@ def build_polygon_with_side(num, side, pv):
     return points
 
 def build_polygon_with_angle(num, angle, pv):
-    radius = get_radius_from_angle(num, angle)
-    side = get_side_from_radius(num, radius)
+    side = get_regular_polygon(num, angle=angle).side
     points = []
     for i in xrange(num):
         pv = pv.advance(side)
@@ -78,17 +121,12 @@ def build_polygon_with_angle(num, angle, pv):
     return points
 
 def get_center_with_side(num, side, pv):
-    radius = get_radius_from_side(num, side)
-    angle = get_angle_from_radius(num, radius)
-    pv.turn(0.5 * angle)
-    pv.advance(radius)
-    return pv.to_point()
+    polygon = get_regular_polygon(num, side=side)
+    return pv.turn(0.5 * polygon.angle).advance(polygon.circumradius).to_point()
 
 def get_center_with_angle(num, angle, pv):
     radius = get_radius_from_angle(num, angle)
-    pv.turn(0.5 * angle)
-    pv.advance(radius)
-    return pv.to_point()
+    return pv.turn(0.5 * angle).advance(radius).to_point()
 
 def draw_polygon(ctx, points):
     for i in xrange(len(points)):
@@ -101,26 +139,55 @@ def draw_polygons(ctx, polygons):
 CACHE_EPSILON = 0.000001
 FAR_FIELD_EPSILON = 0.0001
 
-def build_regular_tessellation(side_num, valence_num, pv, point_cache=None, polygons=None):
+def iter_regular_tessellation(side_num, valence_num, pv, max_depth=None, max_tiles=None,
+                              max_radius=None, point_cache=None):
+    """Generate the tiles of the {side_num, valence_num} tessellation
+    ring by ring, starting with the polygon built on pv. Yield (depth,
+    pvs) couples, where depth is the number of edges crossed to get
+    from the first tile to this one. Tiles deeper than max_depth or
+    whose center is farther than max_radius from the first tile's
+    center are not generated, and at most max_tiles are yielded."""
     if point_cache is None:
         point_cache = GridApproximationPointCache(CACHE_EPSILON)
-    if polygons is None:
-        polygons = []
 
     angle = 2.0 * math.pi / float(valence_num)
-    center = get_center_with_angle(side_num, angle, pv)
+    root_center = get_center_with_angle(side_num, angle, pv)
+    queue = collections.deque([(pv, 0)])
+    tiles = 0
 
-    if point_cache.query(center):
-        return
-    else:
+    while len(queue) > 0:
+        if max_tiles is not None and tiles >= max_tiles:
+            return
+        pv, depth = queue.popleft()
+        center = get_center_with_angle(side_num, angle, pv)
+        if point_cache.query(center):
+            continue
         point_cache.store(center)
+        if max_radius is not None and depth > 0 and root_center.distance(center) > max_radius:
+            continue
+
         pvs = build_polygon_with_angle(side_num, angle, pv)
-        polygons.append(pvs)
-        #draw_polygon(ctx, pvs)
+        tiles += 1
+        yield depth, pvs
+
+        if max_depth is not None and depth >= max_depth:
+            continue
         if min(map(lambda x: x.to_point().to_eupoint().sqnorm(), pvs)) > 1.0 - FAR_FIELD_EPSILON:
-            return
+            continue
         for pv in pvs:
-            build_regular_tessellation(side_num, valence_num, pv, point_cache=point_cache, polygons=polygons)
+            queue.append((pv, depth + 1))
+
+def build_regular_tessellation(side_num, valence_num, pv, point_cache=None, polygons=None,
+                               max_depth=None, max_tiles=None, max_radius=None):
+    if polygons is None:
+        polygons = []
+
+    for depth, pvs in iter_regular_tessellation(side_num, valence_num, pv,
+                                                max_depth=max_depth,
+                                                max_tiles=max_tiles,
+                                                max_radius=max_radius,
+                                                point_cache=point_cache):
+        polygons.append(pvs)
 
     return polygons
 
@@ -136,6 +203,63 @@ def build_segment_list(polygons):
                 segments.append((p1, p2))
     return segments
 
+def build_segment_array(segments):
+    """Pack a list of (Point, Point) tuples in a (N, 2, 2) array of
+    Klein coordinates, suitable for Isometry.map_array()."""
+    array = numpy.empty((len(segments), 2, 2), dtype=numpy.float64)
+    for i, (p1, p2) in enumerate(segments):
+        array[i, 0] = p1.x, p1.y
+        array[i, 1] = p2.x, p2.y
+    return array
+
+def get_visible_segments(ctx, projected):
+    """Return a boolean mask of the segments that are worth drawing,
+    given the (N, 2, 2) array of their endpoints in the current model,
+    and update ctx.cull_stats."""
+    device = user_to_device_array(ctx.cairo, projected)
+    delta = device[:, 1] - device[:, 0]
+    length = numpy.sqrt(delta[:, 0]**2 + delta[:, 1]**2)
+    small = length < ctx.cull_tolerance
+
+    # A geodesic arc in the Poincaré disc is never more than half a
+    # circle, so it does not get farther than half its chord from it
+    if ctx.poincare:
+        margin = 0.5 * length[:, numpy.newaxis]
+    else:
+        margin = 0.0
+    low = device.min(axis=1) - margin
+    high = device.max(axis=1) + margin
+    outside = (high[:, 0] < 0) | (high[:, 1] < 0) | \
+        (low[:, 0] > ctx.size[0]) | (low[:, 1] > ctx.size[1])
+    outside &= ~small
+
+    ctx.cull_stats.culled_small += int(small.sum())
+    ctx.cull_stats.culled_outside += int(outside.sum())
+    return ~(small | outside)
+
+def draw_mapped_segments(ctx, segments):
+    """Draw a (N, 2, 2) array of segments that have already been
+    mapped through ctx.isom."""
+    with profiling.stage(ctx.profiler, 'culling'):
+        if ctx.poincare:
+            projected = klein_to_poincare_array(segments)
+        else:
+            projected = segments
+        if ctx.size is not None:
+            visible = get_visible_segments(ctx, projected)
+            segments = segments[visible]
+            projected = projected[visible]
+        ctx.cull_stats.drawn += len(segments)
+
+    with profiling.stage(ctx.profiler, 'rasterization'):
+        if ctx.poincare:
+            draw_poincare_segment_array(ctx, projected)
+        else:
+            draw_klein_segment_array(ctx, projected)
+
 def draw_segments(ctx, segments):
-    for p1, p2 in segments:
-        p1.segment_to(p2).draw(ctx)
+    """Draw a list of (Point, Point) tuples or a (N, 2, 2) array as
+    returned by build_segment_array()."""
+    if not isinstance(segments, numpy.ndarray):
+        segments = build_segment_array(segments)
+    draw_mapped_segments(ctx, ctx.isom.map_array(segments))
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Per-frame timing of the rendering stages.
+
+Code to be measured is wrapped in
+
+  with profiling.stage(ctx.profiler, 'name'):
+      ...
+
+which costs nothing when the profiler is None. Stages can be nested:
+each stage is accounted only the time not spent in its inner stages,
+so the stages of a frame add up to (at most) its total time."""
+
+import time
+import threading
+import collections
+
+DEFAULT_HISTORY = 600
+
+class NullStage:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_STAGE = NullStage()
+
+def stage(profiler, name):
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
+
+class Stage:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.push(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.pop()
+        return False
+
+class FrameProfiler:
+    """Keep the duration of each stage for the last history frames.
+    Frames are timed by one thread, but the history can be read from
+    any other one."""
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.stage_names = []
+        self.history = collections.deque(maxlen=history)
+        # Guards history and stage_names
+        self.lock = threading.Lock()
+        self.current = None
+        self.frame_start = None
+        self.stack = []
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def start_frame(self):
+        self.current = {}
+        self.stack = []
+        self.frame_start = time.time()
+
+    def end_frame(self):
+        if self.current is None:
+            return
+        self.current['total'] = time.time() - self.frame_start
+        with self.lock:
+            self.history.append((self.frame_start, self.current))
+        self.current = None
+
+    def push(self, name):
+        # Each entry is [name, start time, time spent in inner stages]
+        self.stack.append([name, time.time(), 0.0])
+
+    def pop(self):
+        name, start, inner = self.stack.pop()
+        elapsed = time.time() - start
+        if len(self.stack) > 0:
+            self.stack[-1][2] += elapsed
+        self.add(name, elapsed - inner)
+
+    def add(self, name, elapsed):
+        if self.current is None:
+            return
+        if name not in self.stage_names:
+            with self.lock:
+                self.stage_names.append(name)
+        self.current[name] = self.current.get(name, 0.0) + elapsed
+
+    def get_stage_names(self):
+        with self.lock:
+            return list(self.stage_names)
+
+    def get_last_frames(self, frames=None):
+        with self.lock:
+            last = list(self.history)
+        if frames is None or frames >= len(last):
+            return last
+        return last[-frames:]
+
+    def get_fps(self, frames=None):
+        last = self.get_last_frames(frames)
+        if len(last) < 2:
+            return 0.0
+        elapsed = last[-1][0] - last[0][0]
+        return (len(last) - 1) / elapsed if elapsed > 0.0 else 0.0
+
+    def get_averages(self, frames=None):
+        """Average duration of each stage (and of the whole frame,
+        under 'total') over the last frames."""
+        last = self.get_last_frames(frames)
+        averages = collections.OrderedDict()
+        for name in self.get_stage_names() + ['total']:
+            if len(last) == 0:
+                averages[name] = 0.0
+            else:
+                averages[name] = sum(timings.get(name, 0.0) for start, timings in last) / len(last)
+        return averages
+
+    def dump_csv(self, path):
+        names = self.get_stage_names() + ['total']
+        last = self.get_last_frames()
+        with open(path, 'w') as fout:
+            fout.write(','.join(['start'] + names) + '\n')
+            for start, timings in last:
+                fout.write(','.join(['%f' % (start)] +
+                                    ['%f' % (timings.get(name, 0.0)) for name in names]) + '\n')
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Software rasterization of whole frames with numpy.
+
+Lines and arcs are sampled, all together, at (at most) one pixel
+intervals along their length, and the samples are written into a
+(height, width, 4) RGBA array in one go. With antialiasing each sample
+spreads its length over the four pixels around it (bilinear
+splatting), so that the accumulated coverage of a pixel approximates
+the length of curve crossing it, and the color is blended according
+to it."""
+
+import os
+import math
+import numpy
+import threading
+import multiprocessing.pool
+
+from utils import user_to_device_array, apply_matrix_array
+import chyperbolic
+
+# Distance between consecutive samples, in pixels
+SAMPLE_SPACING = 1.0
+
+def get_pixels(frame_data, size):
+    """A (height, width, 4) array sharing frame_data's memory."""
+    return numpy.frombuffer(frame_data, dtype=numpy.uint8).reshape((size[1], size[0], 4))
+
+def get_device_scale(matrix):
+    """Number of pixels per user unit, for the (xx, yx, xy, yy, x0,
+    y0) tuple of a user to device matrix (assumed to be conformal)."""
+    xx, yx, xy, yy, x0, y0 = matrix
+    return math.sqrt(abs(xx * yy - xy * yx))
+
+def get_sample_params(sample_num):
+    """For curves with the given (positive) numbers of samples, return
+    the index of the curve and the parameter in [0, 1] of each of all
+    the samples."""
+    curve = numpy.repeat(numpy.arange(len(sample_num)), sample_num)
+    starts = numpy.cumsum(sample_num) - sample_num
+    step = 1.0 / numpy.maximum(sample_num - 1, 1)
+    param = (numpy.arange(len(curve)) - starts[curve]) * step[curve]
+    return curve, param
+
+def sample_lines(segments, spacing=SAMPLE_SPACING):
+    """Sample a (N, 2, 2) array of segments in device coordinates;
+    return the (S, 2) array of samples and the (S,) array of the
+    length each of them stands for."""
+    delta = segments[:, 1] - segments[:, 0]
+    length = numpy.sqrt(delta[:, 0]**2 + delta[:, 1]**2)
+    sample_num = numpy.ceil(length / spacing).astype(int) + 1
+    curve, param = get_sample_params(sample_num)
+    points = segments[curve, 0] + param[:, numpy.newaxis] * delta[curve]
+    return points, (length / sample_num)[curve]
+
+def sample_arcs(matrix, arcs, spacing=SAMPLE_SPACING):
+    """Sample a (N, 5) array of arcs in user coordinates, as returned
+    by hyperbolic.get_poincare_arc_array(); return the samples in
+    device coordinates (given the user to device matrix, as a tuple)
+    as sample_lines() does."""
+    span = arcs[:, 4] - arcs[:, 3]
+    span[span < 0.0] += 2*math.pi
+    length = arcs[:, 2] * span * get_device_scale(matrix)
+    sample_num = numpy.ceil(length / spacing).astype(int) + 1
+    curve, param = get_sample_params(sample_num)
+    angle = arcs[curve, 3] + param * span[curve]
+    radius = arcs[curve, 2]
+    points = numpy.empty((len(curve), 2), dtype=numpy.float64)
+    points[:, 0] = arcs[curve, 0] + radius * numpy.cos(angle)
+    points[:, 1] = arcs[curve, 1] + radius * numpy.sin(angle)
+    return apply_matrix_array(matrix, points), (length / sample_num)[curve]
+
+def plot(pixels, points, color, y0=0):
+    """Set the pixels that contain the samples to color; pixels can be
+    the band of the frame that starts at row y0."""
+    height, width = pixels.shape[:2]
+    xy = numpy.floor(points - [0.0, y0]).astype(int)
+    inside = (xy[:, 0] >= 0) & (xy[:, 0] < width) & (xy[:, 1] >= 0) & (xy[:, 1] < height)
+    xy = xy[inside]
+    pixels[xy[:, 1], xy[:, 0], :3] = color
+
+def get_coverage(points, weights, width, height, y0=0.0, optimize=True):
+    """Spread each sample's weight over its four nearest pixels, in
+    the rows from y0 to y0 + height; return the flat array of the
+    coverage of these rows."""
+    if optimize:
+        coverage = numpy.zeros(width * height, dtype=numpy.float64)
+        chyperbolic.c_splat_array(numpy.ascontiguousarray(points, dtype=numpy.float64),
+                                  numpy.ascontiguousarray(weights, dtype=numpy.float64),
+                                  coverage, width, y0)
+        return coverage
+    # Pixel centers are at half integer coordinates
+    shifted = points - [0.5, y0 + 0.5]
+    base = numpy.floor(shifted)
+    frac = shifted - base
+    base = base.astype(int)
+    # Each sample's four pixels and their shares of its weight
+    x = base[:, 0, numpy.newaxis] + [0, 1, 0, 1]
+    y = base[:, 1, numpy.newaxis] + [0, 0, 1, 1]
+    wx = numpy.column_stack([1.0 - frac[:, 0], frac[:, 0]])[:, [0, 1, 0, 1]]
+    wy = numpy.column_stack([1.0 - frac[:, 1], frac[:, 1]])[:, [0, 0, 1, 1]]
+    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+    return numpy.bincount((y * width + x)[inside],
+                          weights=(weights[:, numpy.newaxis] * wx * wy)[inside],
+                          minlength=width * height)
+
+def splat(pixels, points, weights, color, y0=0, optimize=True):
+    """Blend color over the pixels, according to the coverage
+    accumulated by get_coverage(); pixels can be the band of the frame
+    that starts at row y0."""
+    height, width = pixels.shape[:2]
+    coverage = get_coverage(points, weights, width, height, y0, optimize=optimize)
+    covered = numpy.flatnonzero(coverage)
+    alpha = numpy.minimum(coverage[covered], 1.0)[:, numpy.newaxis]
+    flat = pixels.reshape((-1, 4))
+    blended = flat[covered, :3] * (1.0 - alpha) + numpy.array(color, dtype=numpy.float64) * alpha
+    flat[covered, :3] = (blended + 0.5).astype(numpy.uint8)
+
+class NumpyBackend:
+    """Collect the samples of all the segments of a frame and write
+    them into ctx.pixels in finish(), with a few array operations."""
+
+    def __init__(self, antialias=True, spacing=SAMPLE_SPACING):
+        self.antialias = antialias
+        self.spacing = spacing
+        self.points = []
+        self.weights = []
+
+    def __repr__(self):
+        return "NumpyBackend(antialias=%r)" % (self.antialias)
+
+    def get_pixels(self, ctx):
+        if ctx.pixels is None:
+            raise ValueError("NumpyBackend needs ctx.pixels")
+        return ctx.pixels
+
+    def clear(self, ctx, color):
+        pixels = self.get_pixels(ctx)
+        pixels[..., :3] = color
+        pixels[..., 3] = 255
+        self.points = []
+        self.weights = []
+
+    def draw_lines(self, ctx, segments):
+        if len(segments) == 0:
+            return
+        points, weights = sample_lines(user_to_device_array(ctx.cairo, segments), self.spacing)
+        self.points.append(points)
+        self.weights.append(weights)
+
+    def draw_arcs(self, ctx, arcs):
+        if len(arcs) == 0:
+            return
+        points, weights = sample_arcs(tuple(ctx.cairo.get_matrix()), arcs, self.spacing)
+        self.points.append(points)
+        self.weights.append(weights)
+
+    def draw_circle(self, ctx, x, y, radius, color):
+        self.finish(ctx)
+        self.draw_arcs(ctx, numpy.array([[x, y, radius, 0.0, 2*math.pi]]))
+        self.rasterize(ctx, color)
+
+    def rasterize(self, ctx, color):
+        if len(self.points) == 0:
+            return
+        points = numpy.concatenate(self.points)
+        weights = numpy.concatenate(self.weights)
+        self.points = []
+        self.weights = []
+        if self.antialias:
+            splat(self.get_pixels(ctx), points, weights, color)
+        else:
+            plot(self.get_pixels(ctx), points, color)
+
+    def finish(self, ctx):
+        self.rasterize(ctx, (0, 0, 0))
+
+def get_line_rows(segments):
+    """The (N, 2) array of the lowest and highest device row touched by
+    each of a (N, 2, 2) array of segments in device coordinates."""
+    return numpy.column_stack([segments[:, :, 1].min(axis=1) - 1.0,
+                               segments[:, :, 1].max(axis=1) + 1.0])
+
+def get_arc_rows(matrix, arcs):
+    """Like get_line_rows(), for arcs in user coordinates: each arc is
+    within its sagitta from its chord."""
+    span = arcs[:, 4] - arcs[:, 3]
+    span[span < 0.0] += 2*math.pi
+    ends = numpy.empty((len(arcs), 2, 2), dtype=numpy.float64)
+    for i, angle in enumerate([arcs[:, 3], arcs[:, 3] + span]):
+        ends[:, i, 0] = arcs[:, 0] + arcs[:, 2] * numpy.cos(angle)
+        ends[:, i, 1] = arcs[:, 1] + arcs[:, 2] * numpy.sin(angle)
+    rows = get_line_rows(apply_matrix_array(matrix, ends))
+    sagitta = arcs[:, 2] * (1.0 - numpy.cos(0.5 * span)) * get_device_scale(matrix)
+    rows[:, 0] -= sagitta
+    rows[:, 1] += sagitta
+    return rows
+
+# Thread pools shared by all the BandedBackends, by process (a forked
+# process cannot use the threads of its parent) and number of threads
+thread_pools = {}
+thread_pools_lock = threading.Lock()
+
+def get_thread_pool(threads):
+    """A pool of the given number of threads, created the first time
+    it is asked for in this process and then reused, so that
+    backends can be created and thrown away freely."""
+    key = (os.getpid(), threads)
+    with thread_pools_lock:
+        if key not in thread_pools:
+            thread_pools[key] = multiprocessing.pool.ThreadPool(threads)
+        return thread_pools[key]
+
+class BandedBackend(NumpyBackend):
+    """Like NumpyBackend, but ctx.pixels is split into horizontal bands
+    that are sampled and rasterized concurrently by a pool of threads.
+    Each band only gets the segments whose projected bounding box
+    touches it; most of the work is done by numpy and chyperbolic
+    without holding the GIL. The threads are shared with the other
+    BandedBackends (see get_thread_pool())."""
+
+    def __init__(self, antialias=True, spacing=SAMPLE_SPACING, threads=None, bands=None):
+        NumpyBackend.__init__(self, antialias=antialias, spacing=spacing)
+        self.threads = threads if threads is not None else multiprocessing.cpu_count()
+        self.bands = bands if bands is not None else 2 * self.threads
+        self.lines = []
+        self.arcs = []
+
+    def __repr__(self):
+        return "BandedBackend(antialias=%r, threads=%d, bands=%d)" % \
+            (self.antialias, self.threads, self.bands)
+
+    def clear(self, ctx, color):
+        NumpyBackend.clear(self, ctx, color)
+        self.lines = []
+        self.arcs = []
+
+    def draw_lines(self, ctx, segments):
+        if len(segments) > 0:
+            self.lines.append(user_to_device_array(ctx.cairo, segments))
+
+    def draw_arcs(self, ctx, arcs):
+        if len(arcs) > 0:
+            self.arcs.append(arcs)
+
+    def rasterize_band(self, args):
+        pixels, y0, lines, line_rows, arcs, arc_rows, matrix, color = args
+        y1 = y0 + len(pixels)
+        lines = lines[(line_rows[:, 1] >= y0) & (line_rows[:, 0] < y1)]
+        arcs = arcs[(arc_rows[:, 1] >= y0) & (arc_rows[:, 0] < y1)]
+        line_points, line_weights = sample_lines(lines, self.spacing)
+        arc_points, arc_weights = sample_arcs(matrix, arcs, self.spacing)
+        points = numpy.concatenate([line_points, arc_points])
+        weights = numpy.concatenate([line_weights, arc_weights])
+        if self.antialias:
+            splat(pixels, points, weights, color, y0=y0)
+        else:
+            plot(pixels, points, color, y0=y0)
+
+    def rasterize(self, ctx, color):
+        if len(self.lines) == 0 and len(self.arcs) == 0:
+            return
+        empty = numpy.empty((0, 2, 2), dtype=numpy.float64)
+        lines = numpy.concatenate(self.lines) if len(self.lines) > 0 else empty
+        arcs = numpy.concatenate(self.arcs) if len(self.arcs) > 0 else numpy.empty((0, 5))
+        self.lines = []
+        self.arcs = []
+
+        pixels = self.get_pixels(ctx)
+        height = len(pixels)
+        bounds = numpy.linspace(0, height, self.bands + 1).astype(int)
+        # Threads must not call cairo, so they get a copy of its matrix
+        matrix = tuple(ctx.cairo.get_matrix())
+        line_rows = get_line_rows(lines)
+        arc_rows = get_arc_rows(matrix, arcs)
+        tasks = [(pixels[y0:y1], y0, lines, line_rows, arcs, arc_rows, matrix, color)
+                 for y0, y1 in zip(bounds[:-1], bounds[1:]) if y1 > y0]
+        get_thread_pool(self.threads).map(self.rasterize_band, tasks)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Rendering decoupled from input handling.
+
+The input loop only posts the latest view to a Mailbox, which keeps
+nothing else: views posted while a frame is being drawn replace each
+other, and the RenderThread always draws the most recent one. Frames
+are double buffered: the thread draws on the back buffer while the
+front one, the last complete frame, can be shown."""
+
+import time
+import threading
+import contextlib
+
+class Mailbox:
+    """A slot holding only the latest value put in it, with a version
+    number that grows at each put()."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.version = 0
+        self.closed = False
+
+    def put(self, value):
+        with self.cond:
+            self.value = value
+            self.version += 1
+            self.cond.notify_all()
+
+    def get(self, version=0, timeout=None):
+        """Wait until there is a value newer than version and return
+        the (version, value) couple; value is None if the mailbox was
+        closed or timeout expired first."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.version <= version and not self.closed:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0.0:
+                        break
+                    self.cond.wait(remaining)
+            if self.closed or self.version <= version:
+                return version, None
+            return self.version, self.value
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class RenderThread(threading.Thread):
+    """Draw each latest view of views with draw(buffer, view) on one
+    of two buffers, created (and created again when view.size changes)
+    by init_buffer(size)."""
+
+    def __init__(self, views, init_buffer, draw):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.views = views
+        self.init_buffer = init_buffer
+        self.draw = draw
+        self.lock = threading.Lock()
+        self.buffers = [None, None]
+        self.sizes = [None, None]
+        self.front = None
+        self.new_frame = False
+        self.error = None
+        self.rendered = 0
+        self.dropped = 0
+
+    def run(self):
+        version = 0
+        back = 0
+        try:
+            while True:
+                version, view = self.views.get(version)
+                if view is None:
+                    return
+                if self.sizes[back] != view.size:
+                    self.buffers[back] = self.init_buffer(view.size)
+                    self.sizes[back] = view.size
+                self.draw(self.buffers[back], view)
+                with self.lock:
+                    # The previous frame was never shown
+                    if self.new_frame:
+                        self.dropped += 1
+                    self.front = back
+                    self.new_frame = True
+                    self.rendered += 1
+                back = 1 - back
+        except Exception, e:
+            self.error = e
+
+    @contextlib.contextmanager
+    def front_buffer(self):
+        """Yield the (buffer, new) couple, where buffer is the last
+        complete frame (or None if there is none yet) and new tells
+        whether it was not yielded before. The buffer is not drawn on
+        until the with block ends."""
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            new = self.new_frame
+            self.new_frame = False
+            yield (self.buffers[self.front] if self.front is not None else None), new
+
+    def stop(self):
+        self.views.close()
+        self.join()
+
+class BackgroundBuilder(threading.Thread):
+    """Put each value yielded by generator (e.g. more and more complete
+    versions of something slow to build) into mailbox as soon as it is
+    ready."""
+
+    def __init__(self, generator, mailbox):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.generator = generator
+        self.mailbox = mailbox
+        self.built = 0
+        self.done = False
+        self.error = None
+
+    def run(self):
+        try:
+            for value in self.generator:
+                self.mailbox.put(value)
+                self.built += 1
+        except Exception, e:
+            self.error = e
+        self.done = True
+
+class ChangeTracker:
+    """Tell whether the inputs of a frame changed since the last one.
+
+    Inputs are summarized by a key (compared with ==, so isometries
+    and other objects without __eq__ count as changed only when they
+    are replaced); force() makes the next check report a change
+    anyway."""
+
+    def __init__(self):
+        self.key = None
+        self.forced = True
+        self.checks = 0
+        self.changes = 0
+
+    def force(self):
+        self.forced = True
+
+    def check(self, key):
+        changed = self.forced or key != self.key
+        self.key = key
+        self.forced = False
+        self.checks += 1
+        if changed:
+            self.changes += 1
+        return changed
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Frame sinks for offline rendering.
+
+A sink receives rendered frames (PIL images) through write() and
+encodes and stores them on background threads, fed by a bounded
+queue: rendering of the next frames overlaps with the encoding of the
+previous ones, while a slow disk eventually makes write() block
+instead of piling up frames in memory."""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+import Queue
+
+DEFAULT_QUEUE_SIZE = 8
+
+class SinkStats:
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.max_queue_depth = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def __repr__(self):
+        return "SinkStats(frames=%d, bytes=%d, fps=%f, MB/s=%f, max_queue_depth=%d)" % \
+            (self.frames, self.bytes, self.get_fps(), self.get_throughput() / 1e6,
+             self.max_queue_depth)
+
+    def get_elapsed(self):
+        end_time = self.end_time if self.end_time is not None else time.time()
+        return end_time - self.start_time
+
+    def get_fps(self):
+        elapsed = self.get_elapsed()
+        return self.frames / elapsed if elapsed > 0.0 else 0.0
+
+    def get_throughput(self):
+        """Bytes written per second."""
+        elapsed = self.get_elapsed()
+        return self.bytes / elapsed if elapsed > 0.0 else 0.0
+
+class ThreadedFrameSink:
+    """Store frames with encode(frame, image), which runs on one of
+    the writer threads and returns the number of bytes written. Frames
+    are encoded in order only if there is a single thread."""
+
+    def __init__(self, encode, threads=1, queue_size=DEFAULT_QUEUE_SIZE):
+        self.encode = encode
+        self.queue = Queue.Queue(queue_size)
+        self.stats = SinkStats()
+        self.lock = threading.Lock()
+        self.error = None
+        self.threads = [threading.Thread(target=self.run) for i in xrange(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def has_frame(self, frame):
+        """Whether frame was already stored by a previous run."""
+        return False
+
+    def get_queue_depth(self):
+        return self.queue.qsize()
+
+    def write(self, frame, image):
+        """The sink takes ownership of image, which must not be
+        drawn on afterwards."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((frame, image))
+        with self.lock:
+            self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    written = self.encode(*item)
+                    with self.lock:
+                        self.stats.frames += 1
+                        self.stats.bytes += written
+            except Exception, e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.stats.end_time = time.time()
+        if self.error is not None:
+            raise self.error
+
+class PngFrameSink(ThreadedFrameSink):
+    """One PNG file per frame; compression runs on a pool of writer
+    threads."""
+
+    def __init__(self, pattern, threads=2, queue_size=DEFAULT_QUEUE_SIZE):
+        self.pattern = pattern
+        ThreadedFrameSink.__init__(self, self.encode_png, threads=threads,
+                                   queue_size=queue_size)
+
+    def has_frame(self, frame):
+        return os.path.exists(self.pattern % (frame))
+
+    def encode_png(self, frame, image):
+        # Write to a temporary file first, so that an interrupted
+        # render never leaves a truncated frame behind for resume to
+        # skip
+        path = self.pattern % (frame)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            image.save(fout, 'PNG')
+        os.rename(tmp_path, path)
+        return os.path.getsize(path)
+
+class RawVideoSink(ThreadedFrameSink):
+    """Stream uncompressed frames, in order, into a single file or
+    pipe. With y4m the stream is a YUV4MPEG2 (4:4:4) video that can
+    be fed directly to most encoders; otherwise it is raw rgb24. PIL
+    converts to full range (JFIF) YCbCr, which the header declares, as
+    encoders otherwise assume limited range."""
+
+    def __init__(self, fout, size, fps, y4m=True, queue_size=DEFAULT_QUEUE_SIZE):
+        self.fout = fout
+        self.y4m = y4m
+        if y4m:
+            fout.write("YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C444 XCOLORRANGE=FULL\n" %
+                       (size[0], size[1], fps))
+        ThreadedFrameSink.__init__(self, self.encode_frame, threads=1, queue_size=queue_size)
+
+    @classmethod
+    def open(cls, path, size, fps, y4m=True, queue_size=DEFAULT_QUEUE_SIZE):
+        """Open path for writing; '-' is standard output."""
+        if path == '-':
+            fout = sys.stdout
+        else:
+            fout = open(path, 'wb')
+        return cls(fout, size, fps, y4m=y4m, queue_size=queue_size)
+
+    def encode_frame(self, frame, image):
+        written = 0
+        if self.y4m:
+            self.fout.write("FRAME\n")
+            written += 6
+            for band in image.convert('YCbCr').split():
+                data = band.tostring()
+                self.fout.write(data)
+                written += len(data)
+        else:
+            data = image.convert('RGB').tostring()
+            self.fout.write(data)
+            written += len(data)
+        return written
+
+    def close(self):
+        ThreadedFrameSink.close(self)
+        if self.fout is not sys.stdout:
+            self.fout.close()
+
+class PipeVideoSink(RawVideoSink):
+    """Feed the stream to the standard input of an external command,
+    for example ['ffmpeg', '-i', '-', 'video.mkv']."""
+
+    def __init__(self, command, size, fps, y4m=True, queue_size=DEFAULT_QUEUE_SIZE):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        RawVideoSink.__init__(self, self.process.stdin, size, fps, y4m=y4m,
+                              queue_size=queue_size)
+
+    def close(self):
+        RawVideoSink.close(self)
+        self.process.wait()
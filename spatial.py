@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Bounding volume hierarchy over the edges of a tessellation.
+
+Each node of the tree encloses its edges both in a Klein-model
+bounding box (edges are straight in the Klein model, so the box of the
+endpoints is exact) and in a hyperbolic ball, so that distance and box
+queries can discard whole subtrees. Hyperbolic computations are done
+in the hyperboloid model, where a point (x, y) of the Klein disc is
+(x, y, 1) / sqrt(1 - x^2 - y^2) and cosh(d(p, q)) = -<p, q>, with <p,
+q> = p0 q0 + p1 q1 - p2 q2."""
+
+import math
+import numpy
+
+from hyperbolic import Point
+
+LEAF_SIZE = 16
+# Keep points that the view maps too near to the border at a finite
+# distance
+MAX_KLEIN_NORM = 1.0 - 1e-12
+
+def klein_to_hyperboloid_array(xy):
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    sqnorm = numpy.minimum(xy[..., 0]**2 + xy[..., 1]**2, MAX_KLEIN_NORM)
+    res = numpy.empty(xy.shape[:-1] + (3,), dtype=numpy.float64)
+    res[..., :2] = xy
+    res[..., 2] = 1.0
+    return res / numpy.sqrt(1.0 - sqnorm)[..., numpy.newaxis]
+
+def hyperboloid_to_klein_array(p):
+    return p[..., :2] / p[..., 2:]
+
+def minkowski(p, q):
+    return p[..., 0] * q[..., 0] + p[..., 1] * q[..., 1] - p[..., 2] * q[..., 2]
+
+def hyperboloid_distance(p, q):
+    return numpy.arccosh(numpy.maximum(-minkowski(p, q), 1.0))
+
+def normalize_hyperboloid(p):
+    return p / numpy.sqrt(-minkowski(p, p))[..., numpy.newaxis]
+
+class EdgeIndex:
+    """Index the (N, 2, 2) array of edges' endpoints, in Klein
+    coordinates; queries return arrays of indices into it."""
+
+    def __init__(self, segments, leaf_size=LEAF_SIZE, arrays=None):
+        """If arrays (as returned by get_arrays() on an index of the
+        same segments) is given, the tree is not built again."""
+        self.segments = numpy.asarray(segments, dtype=numpy.float64)
+        self.leaf_size = leaf_size
+
+        self.ends = klein_to_hyperboloid_array(self.segments)
+        self.middles = normalize_hyperboloid(self.ends[:, 0] + self.ends[:, 1])
+        self.half_lengths = hyperboloid_distance(self.ends[:, 0], self.middles)
+        self.low = self.segments.min(axis=1)
+        self.high = self.segments.max(axis=1)
+        split_coords = hyperboloid_to_klein_array(self.middles)
+
+        if arrays is not None:
+            self.set_arrays(arrays)
+            return
+        self.order = numpy.arange(len(self.segments))
+        self.nodes = []
+        if len(self.segments) > 0:
+            self.build_node(0, len(self.segments), split_coords)
+
+    def __repr__(self):
+        return "EdgeIndex(edges=%d, nodes=%d)" % (len(self.segments), len(self.nodes))
+
+    def build_node(self, start, end, split_coords):
+        """Each node is a (low, high, center, radius, start, end,
+        children) tuple, where children is None for leaves."""
+        idx = self.order[start:end]
+        low = self.low[idx].min(axis=0)
+        high = self.high[idx].max(axis=0)
+        center = normalize_hyperboloid(self.middles[idx].sum(axis=0))
+        radius = (hyperboloid_distance(center, self.middles[idx]) + self.half_lengths[idx]).max()
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+
+        children = None
+        if end - start > self.leaf_size:
+            coords = split_coords[idx]
+            axis = numpy.argmax(coords.max(axis=0) - coords.min(axis=0))
+            half = (end - start) // 2
+            self.order[start:end] = idx[numpy.argpartition(coords[:, axis], half)]
+            children = (self.build_node(start, start + half, split_coords),
+                        self.build_node(start + half, end, split_coords))
+
+        self.nodes[node_id] = (low, high, center, radius, start, end, children)
+        return node_id
+
+    def get_arrays(self):
+        """The tree as a dictionary of arrays, that can be saved to
+        disk."""
+        node_floats = numpy.empty((len(self.nodes), 8), dtype=numpy.float64)
+        node_ints = numpy.empty((len(self.nodes), 4), dtype=numpy.int64)
+        for i, (low, high, center, radius, start, end, children) in enumerate(self.nodes):
+            node_floats[i, 0:2] = low
+            node_floats[i, 2:4] = high
+            node_floats[i, 4:7] = center
+            node_floats[i, 7] = radius
+            node_ints[i] = (start, end) + (children if children is not None else (-1, -1))
+        return {'order': self.order, 'node_floats': node_floats, 'node_ints': node_ints}
+
+    def set_arrays(self, arrays):
+        self.order = arrays['order']
+        self.nodes = []
+        for floats, (start, end, child1, child2) in zip(arrays['node_floats'],
+                                                        arrays['node_ints'].tolist()):
+            children = (child1, child2) if child1 >= 0 else None
+            self.nodes.append((floats[0:2], floats[2:4], floats[4:7], floats[7],
+                               start, end, children))
+
+    def collect(self, prune):
+        """Return the indices of the edges in the leaves that survive
+        the prune(node) test."""
+        if len(self.nodes) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        chunks = []
+        stack = [0]
+        while len(stack) > 0:
+            node = self.nodes[stack.pop()]
+            if prune(node):
+                continue
+            if node[6] is None:
+                chunks.append(self.order[node[4]:node[5]])
+            else:
+                stack.extend(node[6])
+        if len(chunks) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(chunks)
+
+    def query_radius(self, point, radius):
+        """Indices of the edges whose hyperbolic distance from point
+        is at most radius."""
+        p = klein_to_hyperboloid_array(point.get_coords())
+        prune = lambda node: hyperboloid_distance(p, node[2]) - node[3] > radius
+        candidates = self.collect(prune)
+        return candidates[self.get_distances(p, candidates) <= radius]
+
+    def get_distances(self, p, candidates):
+        """Exact distances between p and the candidate edges."""
+        a = self.ends[candidates, 0]
+        b = self.ends[candidates, 1]
+        dist = numpy.minimum(hyperboloid_distance(p, a), hyperboloid_distance(p, b))
+
+        # Distance from the whole line, with n the normal of the plane
+        # through a and b
+        n = numpy.cross(a, b)
+        n[:, 2] = -n[:, 2]
+        nn = minkowski(n, n)
+        pn = minkowski(p, n)
+        valid = nn > 0.0
+        line_dist = numpy.arcsinh(numpy.abs(pn[valid]) / numpy.sqrt(nn[valid]))
+
+        # It counts only if the foot of the perpendicular falls inside
+        # the segment
+        foot = p - (pn / numpy.where(valid, nn, 1.0))[:, numpy.newaxis] * n
+        foot_klein = foot[:, :2] / foot[:, 2:]
+        a_klein = self.segments[candidates, 0]
+        delta = self.segments[candidates, 1] - a_klein
+        sqlen = numpy.maximum((delta**2).sum(axis=1), 1e-300)
+        t = ((foot_klein - a_klein) * delta).sum(axis=1) / sqlen
+        inside = valid.copy()
+        inside[valid] = (t[valid] >= 0.0) & (t[valid] <= 1.0)
+        dist[inside] = numpy.minimum(dist[inside], line_dist[inside[valid]])
+        return dist
+
+    def query_box(self, low, high):
+        """Indices of the edges that intersect the Klein-model box with
+        corners low = (x0, y0) and high = (x1, y1)."""
+        low = numpy.asarray(low, dtype=numpy.float64)
+        high = numpy.asarray(high, dtype=numpy.float64)
+        prune = lambda node: (node[1] < low).any() or (node[0] > high).any()
+        candidates = self.collect(prune)
+
+        overlap = (self.high[candidates] >= low).all(axis=1) & \
+            (self.low[candidates] <= high).all(axis=1)
+        candidates = candidates[overlap]
+
+        # Separating axis test: the box is missed if all its corners
+        # are strictly on the same side of the edge's line
+        a = self.segments[candidates, 0]
+        delta = self.segments[candidates, 1] - a
+        sides = []
+        for x, y in [(low[0], low[1]), (low[0], high[1]), (high[0], low[1]), (high[0], high[1])]:
+            sides.append(delta[:, 0] * (y - a[:, 1]) - delta[:, 1] * (x - a[:, 0]))
+        sides = numpy.array(sides)
+        separated = (sides > 0.0).all(axis=0) | (sides < 0.0).all(axis=0)
+        return candidates[~separated]
+
+    def query_visible(self, ctx):
+        """Indices of the edges that may be visible in the window of
+        ctx. Isometries preserve distances, so instead of mapping every
+        edge through ctx.isom, the view center is mapped back through
+        its inverse and the index is queried around it."""
+        width, height = ctx.size
+        max_norm = 0.0
+        for x, y in [(0, 0), (width, 0), (0, height), (width, height)]:
+            ux, uy = ctx.cairo.device_to_user(x, y)
+            max_norm = max(max_norm, math.sqrt(ux**2 + uy**2))
+        if max_norm >= 1.0:
+            return numpy.arange(len(self.segments))
+        # Radius of the ball around the view center that contains the
+        # window, in the current model
+        if ctx.poincare:
+            radius = 2.0 * math.atanh(max_norm)
+        else:
+            radius = math.atanh(max_norm)
+        center = ctx.isom.get_inverse().map(Point(0.0, 0.0))
+        return self.query_radius(center, radius)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of tessellation buffers.
+
+Each entry is a directory holding one .npy file per array and a
+meta.json file with its key. Arrays are loaded memory mapped, so that
+loading costs (almost) nothing until pages are actually touched. Keys
+are dictionaries describing what was built (tiling, root, cutoffs,
+epsilon...); the format version and a hash of the source of the
+modules that build the arrays are added to them, so that entries built
+by different code are never used."""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import tempfile
+import numpy
+
+FORMAT_VERSION = 1
+DEFAULT_DIRECTORY = os.environ.get('HYPERBOLIC_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'hyperbolic'))
+META_NAME = 'meta.json'
+
+def get_source_file(obj):
+    try:
+        return inspect.getsourcefile(obj)
+    except TypeError:
+        # Built in
+        return None
+
+def get_module_dependencies(modules):
+    """modules and all the modules they import (directly, or through
+    the functions and classes imported from them), recursively, that
+    live in the same directories as modules. Modules without Python
+    source (like chyperbolic) are left out."""
+    directories = set(os.path.dirname(os.path.abspath(get_source_file(module)))
+                      for module in modules)
+    found = {}
+    pending = list(modules)
+    while len(pending) > 0:
+        module = pending.pop()
+        path = get_source_file(module)
+        if module.__name__ in found or path is None or \
+                os.path.dirname(os.path.abspath(path)) not in directories:
+            continue
+        found[module.__name__] = module
+        for value in vars(module).values():
+            if inspect.ismodule(value):
+                pending.append(value)
+            elif getattr(value, '__module__', None) in sys.modules:
+                pending.append(sys.modules[value.__module__])
+    return [found[name] for name in sorted(found)]
+
+def get_code_version(modules):
+    """Hash of the source of modules and of the ones they depend on
+    (see get_module_dependencies())."""
+    digest = hashlib.sha1()
+    for module in get_module_dependencies(modules):
+        with open(get_source_file(module), 'rb') as fin:
+            digest.update(fin.read())
+    return digest.hexdigest()
+
+class TessellationStore:
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, modules=(), verbose=True):
+        """modules are the ones whose code builds the stored arrays;
+        the code of the modules they use affects them too."""
+        self.directory = directory
+        self.code_version = get_code_version(modules)
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self.last_status = None
+        self.last_seconds = None
+
+    def __repr__(self):
+        return "TessellationStore(%r, hits=%d, misses=%d)" % (self.directory, self.hits, self.misses)
+
+    def get_full_key(self, key):
+        full_key = dict(key)
+        full_key['format_version'] = FORMAT_VERSION
+        full_key['code_version'] = self.code_version
+        return full_key
+
+    def get_path(self, key):
+        encoded = json.dumps(self.get_full_key(key), sort_keys=True)
+        return os.path.join(self.directory, hashlib.sha1(encoded).hexdigest())
+
+    def load(self, key):
+        """Return the dictionary of the (memory mapped) arrays stored
+        under key, or None if there is no valid entry."""
+        path = self.get_path(key)
+        try:
+            with open(os.path.join(path, META_NAME)) as fin:
+                meta = json.load(fin)
+            if meta['key'] != json.loads(json.dumps(self.get_full_key(key))):
+                return None
+            return dict((name, numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+                        for name in meta['arrays'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, arrays):
+        """Store arrays under key; the entry is written in a temporary
+        directory and then renamed, so that it is never seen half
+        written."""
+        path = self.get_path(key)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = tempfile.mkdtemp(dir=self.directory)
+        for name, array in arrays.iteritems():
+            numpy.save(os.path.join(tmp_path, name + '.npy'), numpy.ascontiguousarray(array))
+        with open(os.path.join(tmp_path, META_NAME), 'w') as fout:
+            json.dump({'key': self.get_full_key(key), 'arrays': sorted(arrays.keys())}, fout,
+                      sort_keys=True)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def get(self, key, build):
+        """Load the arrays stored under key; if there are none, call
+        build() to get them and store them."""
+        start = time.time()
+        arrays = self.load(key)
+        if arrays is not None:
+            self.hits += 1
+            self.last_status = 'hit'
+        else:
+            self.misses += 1
+            self.last_status = 'miss'
+            arrays = build()
+            try:
+                self.save(key, arrays)
+            except (IOError, OSError), e:
+                print >> sys.stderr, "Could not store tessellation: %s" % (e)
+        self.last_seconds = time.time() - start
+        if self.verbose:
+            print >> sys.stderr, "Tessellation cache %s (%.3f s): %s" % \
+                (self.last_status, self.last_seconds, self.get_path(key))
+        return arrays
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import hyperbolic
+import polygons
+import coxeter
+
+TILINGS = [(5, 5), (5, 4), (3, 7), (7, 3), (4, 6)]
+MAX_RADIUS = 3.0
+
+class CoxeterTessellationTest(unittest.TestCase):
+
+    def test_same_tiles_as_regular_tessellation(self):
+        """Cut at the same radius, the Coxeter enumeration and the ring
+        by ring construction give the same number of tiles."""
+        for side_num, valence_num in TILINGS:
+            pv = hyperbolic.PointedVector(0.0, 0.0, 0.0)
+            regular = list(polygons.iter_regular_tessellation(side_num, valence_num, pv,
+                                                               max_radius=MAX_RADIUS))
+            tiles = list(coxeter.iter_coxeter_tessellation(side_num, valence_num,
+                                                           max_radius=MAX_RADIUS))
+            self.assertEqual(len(tiles), len(regular), (side_num, valence_num))
+
+    def test_no_duplicate_tiles(self):
+        origin = hyperbolic.Point(0.0, 0.0)
+        for side_num, valence_num in TILINGS:
+            tiles = list(coxeter.iter_coxeter_tessellation(side_num, valence_num,
+                                                           max_radius=MAX_RADIUS))
+            words = set(word for word, isom in tiles)
+            centers = set()
+            for word, isom in tiles:
+                x, y = isom.map(origin).get_coords()
+                centers.add((round(x, 6), round(y, 6)))
+            self.assertEqual(len(words), len(tiles), (side_num, valence_num))
+            self.assertEqual(len(centers), len(tiles), (side_num, valence_num))
+
+if __name__ == '__main__':
+    unittest.main()
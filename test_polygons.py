@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+import unittest
+import numpy
+
+try:
+    from scipy import optimize
+except ImportError:
+    optimize = None
+
+import hyperbolic
+import polygons
+
+# (sides, circumradius) couples
+POLYGONS = [(3, 0.5), (3, 2.0), (4, 1.0), (5, 0.1), (5, 1.5), (7, 0.8), (8, 3.0), (12, 2.2)]
+TILINGS = [(5, 5), (5, 4), (3, 7), (7, 3), (4, 6), (8, 8)]
+
+# The numeric construction the closed form replaced: build the polygon
+# and measure it, and invert with brentq
+
+MIN_SEARCH = 0.00000001
+MAX_SEARCH = 10.0
+
+def get_angle_by_construction(num, radius):
+    origin = hyperbolic.PointedVector(0.0, 0.0, 0.0)
+    p1 = origin.advance(radius)
+    p2 = origin.turn(2 * math.pi / float(num)).advance(radius)
+    ray_line = origin.to_line().reverse()
+    side_line = p1.to_point().line_to(p2.to_point())
+    return 2.0 * ray_line.angle_with(side_line, intersection=p1)
+
+def get_side_by_construction(num, radius):
+    origin = hyperbolic.PointedVector(0.0, 0.0, 0.0)
+    p1 = origin.advance(radius)
+    p2 = origin.turn(2 * math.pi / float(num)).advance(radius)
+    return p1.to_point().distance(p2.to_point())
+
+class RegularPolygonTest(unittest.TestCase):
+
+    def test_closed_form_matches_construction(self):
+        for num, radius in POLYGONS:
+            polygon = polygons.get_regular_polygon(num, radius=radius)
+            self.assertAlmostEqual(polygon.side, get_side_by_construction(num, radius), places=9)
+            self.assertAlmostEqual(polygon.angle, get_angle_by_construction(num, radius), places=9)
+
+    @unittest.skipIf(optimize is None, "scipy is not available")
+    def test_inverses_match_brentq(self):
+        for num, radius in POLYGONS:
+            side = get_side_by_construction(num, radius)
+            angle = get_angle_by_construction(num, radius)
+            by_side = optimize.brentq(lambda x: get_side_by_construction(num, x) - side,
+                                      MIN_SEARCH, MAX_SEARCH)
+            by_angle = optimize.brentq(lambda x: get_angle_by_construction(num, x) - angle,
+                                       MIN_SEARCH, MAX_SEARCH)
+            self.assertAlmostEqual(polygons.get_radius_from_side(num, side), by_side, places=9)
+            self.assertAlmostEqual(polygons.get_radius_from_angle(num, angle), by_angle, places=9)
+
+    @unittest.skipIf(optimize is None, "scipy is not available")
+    def test_tessellation_polygons_match_brentq(self):
+        for side_num, valence_num in TILINGS:
+            angle = 2.0 * math.pi / valence_num
+            radius = optimize.brentq(lambda x: get_angle_by_construction(side_num, x) - angle,
+                                     MIN_SEARCH, MAX_SEARCH)
+            polygon = polygons.get_tessellation_polygon(side_num, valence_num)
+            self.assertAlmostEqual(polygon.circumradius, radius, places=9)
+
+    def test_inradius(self):
+        """The inradius is the distance from the center to the middle
+        of a side."""
+        for num, radius in POLYGONS:
+            polygon = polygons.get_regular_polygon(num, radius=radius)
+            origin = hyperbolic.PointedVector(0.0, 0.0, 0.0)
+            p1 = origin.advance(radius).to_point()
+            p2 = origin.turn(2 * math.pi / float(num)).advance(radius).to_point()
+            middle = origin.turn(math.pi / float(num)).advance(polygon.inradius).to_point()
+            self.assertAlmostEqual(middle.distance(p1), 0.5 * polygon.side, places=9)
+            self.assertAlmostEqual(middle.distance(p2), 0.5 * polygon.side, places=9)
+
+    def test_no_polygon(self):
+        # Euclidean and spherical tilings have no hyperbolic tile
+        for side_num, valence_num in [(4, 4), (3, 6), (6, 3), (3, 3)]:
+            self.assertRaises(ValueError, polygons.get_tessellation_polygon, side_num, valence_num)
+        self.assertRaises(ValueError, polygons.get_regular_polygon, 5)
+        self.assertRaises(ValueError, polygons.get_regular_polygon, 5, radius=1.0, side=1.0)
+
+    def test_vectorized_matches_scalar(self):
+        nums = numpy.array([num for num, radius in POLYGONS])
+        radii = numpy.array([radius for num, radius in POLYGONS])
+        solved = polygons.solve_regular_polygon(nums, radius=radii)
+        for i, (num, radius) in enumerate(POLYGONS):
+            polygon = polygons.get_regular_polygon(num, radius=radius)
+            for field in polygons.RegularPolygon._fields:
+                self.assertAlmostEqual(getattr(solved, field)[i], getattr(polygon, field), places=12)
+        angles = polygons.solve_regular_polygon(4, angle=numpy.array([0.5 * math.pi, 0.25 * math.pi]))
+        self.assertTrue(numpy.isnan(angles.circumradius[0]))
+        self.assertFalse(numpy.isnan(angles.circumradius[1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+import numpy
+
+import hyperbolic
+import polygons
+import spatial
+
+RADII = [0.05, 0.3, 1.0, 2.5]
+SAMPLES = 2001
+
+def segment_intersects_box(a, b, low, high):
+    """Clip the segment from a to b against the box (Liang-Barsky)."""
+    t0, t1 = 0.0, 1.0
+    for axis in xrange(2):
+        delta = b[axis] - a[axis]
+        for p, q in [(-delta, a[axis] - low[axis]), (delta, high[axis] - a[axis])]:
+            if p == 0.0:
+                if q < 0.0:
+                    return False
+            elif p < 0.0:
+                t0 = max(t0, q / p)
+            else:
+                t1 = min(t1, q / p)
+    return t0 <= t1
+
+class EdgeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        tessellation = polygons.build_regular_tessellation(5, 5, hyperbolic.PointedVector(0.0, 0.0, 0.0),
+                                                           max_depth=3)
+        self.segments = polygons.build_segment_array(polygons.build_segment_list(tessellation))
+        # Small leaves, so that there are many levels to prune
+        self.index = spatial.EdgeIndex(self.segments, leaf_size=4)
+        self.everything = numpy.arange(len(self.segments))
+        rng = numpy.random.RandomState(0)
+        radius = numpy.tanh(rng.uniform(0.0, 3.0, 20))
+        alpha = rng.uniform(0.0, 2.0 * numpy.pi, 20)
+        self.points = [hyperbolic.Point(r * numpy.cos(a), r * numpy.sin(a)) for r, a in zip(radius, alpha)]
+
+    def test_distances_match_sampling(self):
+        """Edges are straight in the Klein model, so the nearest of many
+        samples along them is almost as near as the edge."""
+        t = numpy.linspace(0.0, 1.0, SAMPLES)[:, numpy.newaxis]
+        for point in self.points[:5]:
+            p = spatial.klein_to_hyperboloid_array(point.get_coords())
+            exact = self.index.get_distances(p, self.everything)
+            for i, (a, b) in enumerate(self.segments):
+                samples = spatial.klein_to_hyperboloid_array(a + t * (b - a))
+                sampled = spatial.hyperboloid_distance(p, samples).min()
+                self.assertTrue(exact[i] <= sampled + 1e-6)
+                self.assertAlmostEqual(exact[i], sampled, places=3)
+
+    def test_query_radius_matches_brute_force(self):
+        for point in self.points:
+            p = spatial.klein_to_hyperboloid_array(point.get_coords())
+            distances = self.index.get_distances(p, self.everything)
+            for radius in RADII:
+                expected = numpy.nonzero(distances <= radius)[0]
+                found = numpy.sort(self.index.query_radius(point, radius))
+                self.assertEqual(found.tolist(), expected.tolist())
+
+    def test_query_box_matches_brute_force(self):
+        rng = numpy.random.RandomState(1)
+        for i in xrange(50):
+            corners = rng.uniform(-1.0, 1.0, (2, 2))
+            low, high = corners.min(axis=0), corners.max(axis=0)
+            expected = [j for j, (a, b) in enumerate(self.segments)
+                        if segment_intersects_box(a, b, low, high)]
+            found = numpy.sort(self.index.query_box(low, high))
+            self.assertEqual(found.tolist(), expected)
+
+    def test_arrays_give_the_same_index(self):
+        index = spatial.EdgeIndex(self.segments, leaf_size=4, arrays=self.index.get_arrays())
+        for point in self.points:
+            self.assertEqual(numpy.sort(index.query_radius(point, 0.5)).tolist(),
+                             numpy.sort(self.index.query_radius(point, 0.5)).tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import math
+import numpy
 
 def get_actual_dimension(ctx, d):
     x, y = ctx.device_to_user_distance(d, 0.0)
     return math.sqrt(x**2 + y**2)
+
+def user_to_device_array(ctx, xy):
+    """Like ctx.user_to_device(), but for an array whose last
+    dimension is 2."""
+    return apply_matrix_array(tuple(ctx.get_matrix()), xy)
+
+def apply_matrix_array(matrix, xy):
+    """Apply a cairo matrix, given as its (xx, yx, xy, yy, x0, y0)
+    tuple, to an array whose last dimension is 2."""
+    xx, yx, xy_, yy, x0, y0 = matrix
+    res = numpy.empty(xy.shape, dtype=numpy.float64)
+    res[..., 0] = xx * xy[..., 0] + xy_ * xy[..., 1] + x0
+    res[..., 1] = yx * xy[..., 0] + yy * xy[..., 1] + y0
+    return res